@@ -8,15 +8,51 @@ import os
 import streamlit as st
 from pathlib import Path
 import chromadb
+import hashlib
+import re
+import sqlite3
+import threading
 import time
-from sentence_transformers import SentenceTransformer
+from collections import OrderedDict
+import numpy as np
+from onnx_encoder import create_encoder
 from typing import List, Dict
 import json
 from datetime import datetime
+import httpx
 from openai import OpenAI
 import docx
 import PyPDF2
 import io
+from concurrent.futures import ThreadPoolExecutor
+
+# pypdf is the maintained PyPDF2 fork with noticeably faster extract_text
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# tiktoken gives exact token counts for budgeting; fall back to a chars/4 estimate
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Pin PyTorch's thread pools and drop autograd up front: some hosts default to
+# one intra-op thread, and embedding inference never needs gradients
+import contextlib
+try:
+    import torch
+    torch.set_num_threads(os.cpu_count() or 4)
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        pass  # interop pool already started
+    torch.set_grad_enabled(False)
+    _inference_ctx = torch.inference_mode
+except ImportError:
+    torch = None
+    _inference_ctx = contextlib.nullcontext
 
 # Load environment variables
 try:
@@ -25,31 +61,217 @@ try:
 except ImportError:
     pass
 
+class QueryCache:
+    """Thread-safe LRU cache with a TTL, used to memoize query embeddings"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def _accelerate_torch_model(model):
+    """Compile the eager-PyTorch fallback's transformer and warm it up; the
+    ONNX encoder path needs none of this and is returned untouched"""
+    if torch is None or not hasattr(model, '_first_module'):
+        return model
+    try:
+        model.eval()
+        # Queries vary in token length, so leave dynamic shapes to the
+        # compiler: dynamic=False would trigger a recompile per novel length
+        model._first_module().auto_model = torch.compile(
+            model._first_module().auto_model, mode='reduce-overhead'
+        )
+        # Trigger compilation at load time instead of on the first user query
+        model.encode("warmup")
+    except Exception:
+        pass
+    return model
+
+@st.cache_resource
+def _query_cache():
+    """Repeated questions skip the MiniLM forward pass entirely; cleared after
+    ingest. Lives behind cache_resource because Streamlit re-executes this
+    script per interaction and a module-level instance would start empty
+    every rerun"""
+    return QueryCache()
+
+@st.cache_resource
+def _extract_pool():
+    """Runs document extraction concurrently with SOP retrieval on submit.
+    One pool for the process — a module-level pool would be recreated (and
+    its threads leaked) on every rerun"""
+    return ThreadPoolExecutor(max_workers=2)
+
+# Context assembly works in tokens, not characters: hardcoded [:500]/[:3000]
+# slices cut mid-sentence and spend the OpenAI input budget blindly
+_CONTEXT_TOKEN_BUDGET = 2000
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+
+@st.cache_resource
+def _token_encoder():
+    if tiktoken is None:
+        return None
+    return tiktoken.get_encoding("cl100k_base")
+
+def _count_tokens(text: str) -> int:
+    encoder = _token_encoder()
+    if encoder is None:
+        return max(1, len(text) // 4)
+    return len(encoder.encode(text))
+
+def _truncate_to_tokens(text: str, budget: int) -> str:
+    """Trim text to roughly `budget` tokens, cutting at sentence boundaries"""
+    if _count_tokens(text) <= budget:
+        return text
+    parts = []
+    used = 0
+    for sentence in _SENTENCE_RE.split(text):
+        sentence_tokens = _count_tokens(sentence)
+        if used + sentence_tokens > budget:
+            break
+        parts.append(sentence)
+        used += sentence_tokens
+    return ' '.join(parts) if parts else text[:budget * 4]
+
+_UPLOADS_DIR = Path("uploads")
+
+# Re-attaching the same document skips the 100-500ms PDF/DOCX parse entirely
+_EXTRACT_CACHE_DIR = Path("cache/extracted")
+
+def store_upload(content: str) -> Dict:
+    """Write extracted text to a content-addressed file and return a small
+    reference; keeping megabyte document bodies out of session state stops
+    every rerun from dragging them along"""
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    path = _UPLOADS_DIR / f"{digest}.txt"
+    if not path.exists():
+        _UPLOADS_DIR.mkdir(exist_ok=True)
+        path.write_text(content)
+    return {'path': str(path), 'sha1': digest}
+
+@st.cache_resource
+def get_chroma_collection():
+    """Open the persistent Chroma client once per process and share its collection"""
+    # Cosine is MiniLM's native space; on unit vectors each distance is a dot product
+    return chromadb.PersistentClient(path="./chroma_db").get_or_create_collection(
+        "sop_documents",
+        metadata={"hnsw:space": "cosine"}
+    )
+
+@st.cache_data(ttl=60, show_spinner=False)
+def count_unique_sources(chunk_count: int) -> int:
+    """Unique SOP sources; keyed on chunk count so a stale value only lives
+    until the next ingest. The fetcher persists the count at index time, so
+    the normal path is one small JSON read — the full metadata scan (every
+    chunk's dict across the SQLite/HNSW boundary) is only the fallback for
+    collections indexed before the count was recorded"""
+    try:
+        with open("sop_metadata.json", 'r') as f:
+            count = json.load(f).get("unique_source_count")
+        if count is not None:
+            return count
+    except (OSError, ValueError):
+        pass
+    metadata = get_chroma_collection().get(include=['metadatas'])
+    return len({m.get('source', '') for m in metadata['metadatas']})
+
+@st.cache_resource
+def get_embedder():
+    """Load the encoder once per process: session_state would duplicate the
+    ~90MB model for every browser tab, scaling RAM with concurrent users"""
+    # int8 ONNX encoder (~2-4x faster per query on CPU); falls back to
+    # the eager SentenceTransformer when optimum/onnxruntime are absent
+    return _accelerate_torch_model(create_encoder())
+
+@st.cache_resource
+def get_openai_client():
+    """Shared keepalive client reuses the TCP/TLS connection across turns"""
+    return OpenAI(
+        api_key=os.environ.get('OPENAI_API_KEY'),
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=30)
+        )
+    )
+
 class SOPAssistant:
     def __init__(self):
-        self.openai_client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-        if 'embedding_model' not in st.session_state:
-            st.session_state.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.embedding_model = st.session_state.embedding_model
-        self.chroma_client = chromadb.PersistentClient(path="./chroma_db")
-        self.collection = self.chroma_client.get_or_create_collection("sop_documents")
-    
+        self.openai_client = get_openai_client()
+        self.embedding_model = get_embedder()
+        self.collection = get_chroma_collection()
+        threading.Thread(target=self._warmup, daemon=True).start()
+
+    def _warmup(self):
+        """Absorb cold-start tails off the critical path: the first encode
+        (lazy tokenizer init), first HNSW query (index mmap), and the OpenAI
+        TLS handshake all happen before the first user message needs them"""
+        try:
+            with _inference_ctx():
+                embedding = self.embedding_model.encode("warmup")
+            self.collection.query(query_embeddings=[embedding.tolist()], n_results=1)
+        except Exception:
+            pass
+        try:
+            self.openai_client.models.list()
+        except Exception:
+            pass
+
     def extract_text_from_file(self, uploaded_file):
-        """Extract text from uploaded document"""
+        """Extract text from uploaded document, reusing cached results for
+        documents that were already extracted in an earlier turn or session"""
+        key = hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+        cached = _EXTRACT_CACHE_DIR / f"{key}.txt"
+        try:
+            if cached.exists():
+                return cached.read_text()
+        except OSError:
+            pass
+        text = self._extract_text(uploaded_file)
+        if not text.startswith("Error") and text != "Unsupported file type":
+            try:
+                _EXTRACT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                cached.write_text(text)
+            except OSError:
+                pass
+        return text
+
+    def _extract_text(self, uploaded_file):
         try:
             if uploaded_file.type == "application/pdf":
-                pdf_reader = PyPDF2.PdfReader(io.BytesIO(uploaded_file.read()))
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-                return text
-            
+                # Hand the file-like straight to the reader (it buffers
+                # internally) and join page texts once instead of += per page
+                reader_cls = pypdf.PdfReader if pypdf is not None else PyPDF2.PdfReader
+                pdf_reader = reader_cls(uploaded_file)
+                parts = [page.extract_text() or "" for page in pdf_reader.pages]
+                return "\n".join(parts)
+
             elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                doc = docx.Document(io.BytesIO(uploaded_file.read()))
-                text = ""
-                for paragraph in doc.paragraphs:
-                    text += paragraph.text + "\n"
-                return text
+                doc = docx.Document(uploaded_file)
+                return "\n".join(paragraph.text for paragraph in doc.paragraphs)
             
             elif uploaded_file.type == "text/plain":
                 return str(uploaded_file.read(), "utf-8")
@@ -59,21 +281,43 @@ class SOPAssistant:
         except Exception as e:
             return f"Error reading file: {str(e)}"
     
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Encode many texts in one call; in-batch padding amortizes the
+        tokenizer and transformer kernel launches versus per-text encodes"""
+        with _inference_ctx():
+            return self.embedding_model.encode(
+                texts,
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+
     def search_sops(self, query: str) -> List[Dict]:
         try:
-            embedding = self.embedding_model.encode(query)
+            # Cache the normalized float32 ndarray: half the bytes of a
+            # float64 vector per entry
+            embedding = _query_cache().get(query)
+            if embedding is None:
+                with _inference_ctx():
+                    embedding = self.embedding_model.encode(
+                        query, normalize_embeddings=True, convert_to_numpy=True
+                    ).astype(np.float32)
+                _query_cache().put(query, embedding)
+            # chromadb 0.4.x only accepts list-of-list embeddings
             results = self.collection.query(
                 query_embeddings=[embedding.tolist()],
                 n_results=5,
                 include=['documents', 'metadatas', 'distances']
             )
-            
+
             return [{
                 'text': results['documents'][0][i],
                 'metadata': results['metadatas'][0][i],
                 'similarity': 1 - results['distances'][0][i]
             } for i in range(len(results['documents'][0]))]
-        except:
+        except Exception as e:
+            print(f"SOP search failed: {e}")
             return []
     
     def generate_response(self, query: str, chunks: List[Dict], uploaded_context: str = ""):
@@ -81,21 +325,51 @@ class SOPAssistant:
             return "I couldn't find relevant information in your SOPs or uploaded documents."
         
         context = ""
-        
+        budget = _CONTEXT_TOKEN_BUDGET
+
         # Add uploaded document context first (higher priority)
         if uploaded_context:
-            context += f"UPLOADED DOCUMENT CONTENT:\n{uploaded_context[:3000]}\n\n"
-        
-        # Add SOP context
+            doc_text = _truncate_to_tokens(
+                uploaded_context, int(budget * 0.6) if chunks else budget
+            )
+            budget -= _count_tokens(doc_text)
+            context += f"UPLOADED DOCUMENT CONTENT:\n{doc_text}\n\n"
+
+        # Greedily pack SOP chunks, best match first, until the budget runs out
         if chunks:
-            context += "RELEVANT SOP DOCUMENTS:\n" + "\n\n".join([
-                f"Document: {chunk['metadata']['source']}\n{chunk['text'][:500]}"
-                for chunk in chunks[:3]
-            ])
+            ranked = sorted(chunks, key=lambda c: c.get('similarity', 0), reverse=True)
+            selected = []
+            for chunk in ranked:
+                if budget <= 0:
+                    break
+                meta = chunk['metadata']
+                allowance = min(budget, 200)
+                if meta.get('tokens') is not None and meta['tokens'] <= allowance:
+                    # Ingest-time token count says the whole chunk fits:
+                    # no tokenizer work at all on this path
+                    snippet = chunk['text']
+                    budget -= meta['tokens']
+                else:
+                    # head_500 bounds the truncation input to 500 tokens for
+                    # chunks indexed with token metadata
+                    snippet = _truncate_to_tokens(
+                        meta.get('head_500', chunk['text']), allowance
+                    )
+                    budget -= _count_tokens(snippet)
+                selected.append((meta['source'], snippet))
+            if selected:
+                # Canonical source order: identical retrieval sets yield an
+                # identical token stream, so provider prompt caching can hit
+                selected.sort(key=lambda pair: pair[0])
+                context += "RELEVANT SOP DOCUMENTS:\n" + "\n\n".join(
+                    f"Document: {source}\n{snippet}" for source, snippet in selected
+                )
         
-        # Create focused prompt based on what's available
+        # Create focused prompt based on what's available. Stable content
+        # (instructions, then context) leads and the per-turn question comes
+        # last, so repeated-context turns share a cacheable prompt prefix
         if uploaded_context and chunks:
-            prompt = f"""You are analyzing both an uploaded document and existing SOP documents to answer this question: "{query}"
+            prompt = f"""You are analyzing both an uploaded document and existing SOP documents.
 
 {context}
 
@@ -103,10 +377,12 @@ Please provide a comprehensive answer that:
 1. Primarily analyzes the uploaded document content in relation to the question
 2. Cross-references with relevant SOP information when applicable
 3. Gives specific, actionable information
-4. Clearly indicates which source you're referencing"""
-        
+4. Clearly indicates which source you're referencing
+
+Question: "{query}\""""
+
         elif uploaded_context:
-            prompt = f"""You are analyzing an uploaded document to answer this question: "{query}"
+            prompt = f"""You are analyzing an uploaded document.
 
 {context}
 
@@ -114,18 +390,23 @@ Please provide a detailed analysis of the uploaded document that:
 1. Directly addresses the question asked
 2. Extracts relevant information from the document
 3. Provides specific details, steps, or insights from the document content
-4. Organizes the information in a clear, professional manner"""
-        
+4. Organizes the information in a clear, professional manner
+
+Question: "{query}\""""
+
         else:
-            prompt = f"""Answer this question using the SOP documents provided: "{query}"
+            prompt = f"""Answer the question using the SOP documents provided.
 
 {context}
 
-Provide a clear, professional answer with specific steps if applicable."""
-        
+Provide a clear, professional answer with specific steps if applicable.
+
+Question: "{query}\""""
+
         return prompt
 
     def stream_response(self, prompt: str, model: str = "gpt-4o-mini"):
+        self.last_usage = None
         try:
             stream = self.openai_client.chat.completions.create(
                 model=model,
@@ -134,39 +415,121 @@ Provide a clear, professional answer with specific steps if applicable."""
                     {"role": "user", "content": prompt}
                 ],
                 stream=True,
+                stream_options={'include_usage': True},
                 temperature=0.3
             )
-            
+
             for chunk in stream:
-                if chunk.choices[0].delta.content:
+                # The final usage chunk has no choices; keep the prompt and
+                # completion token counts for budgeting decisions next turn
+                if chunk.usage is not None:
+                    self.last_usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
                     yield chunk.choices[0].delta.content
         except Exception as e:
             yield f"Error: {str(e)}"
 
-def load_chat_sessions():
+# Chats persist in SQLite with WAL journaling: each turn writes only the new
+# row instead of re-serializing every session to chat_sessions.json
+@st.cache_resource
+def _chat_db():
+    conn = sqlite3.connect('chat.db', isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY, title TEXT, created TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+        session_id TEXT, idx INTEGER, role TEXT, content TEXT, sources_json TEXT,
+        PRIMARY KEY (session_id, idx))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+        session_id TEXT, name TEXT, content TEXT,
+        PRIMARY KEY (session_id, name))""")
+    _migrate_legacy_sessions(conn)
+    return conn
+
+def _migrate_legacy_sessions(conn):
+    """One-time import of the old chat_sessions.json blob"""
+    legacy = Path("chat_sessions.json")
+    if not legacy.exists() or conn.execute("SELECT 1 FROM sessions LIMIT 1").fetchone():
+        return
+    try:
+        with open(legacy, 'r') as f:
+            sessions = json.load(f)
+    except:
+        return
+    for chat_id, chat in sessions.items():
+        conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                     (chat_id, chat.get('title', 'Untitled Chat'), chat.get('created')))
+        for idx, msg in enumerate(chat.get('messages', [])):
+            sources = msg.get('sources')
+            conn.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                         (chat_id, idx, msg.get('role'), msg.get('content'),
+                          json.dumps(sources) if sources else None))
+        for name, content in chat.get('documents', {}).items():
+            conn.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                         (chat_id, name, content))
+
+def save_session_meta(chat_id, chat):
+    try:
+        _chat_db().execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                           (chat_id, chat.get('title', 'Untitled Chat'), chat.get('created')))
+    except:
+        pass
+
+def append_message(chat_id, idx, message):
     try:
-        if Path("chat_sessions.json").exists():
-            with open("chat_sessions.json", 'r') as f:
-                return json.load(f)
+        sources = message.get('sources')
+        _chat_db().execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                           (chat_id, idx, message['role'], message['content'],
+                            json.dumps(sources) if sources else None))
     except:
         pass
-    return {}
 
-def save_chat_sessions(chat_sessions):
+def save_document(chat_id, name, content):
     try:
-        with open("chat_sessions.json", 'w') as f:
-            json.dump(chat_sessions, f, indent=2)
+        _chat_db().execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                           (chat_id, name, content))
     except:
         pass
 
+def load_chat_sessions():
+    try:
+        conn = _chat_db()
+        sessions = {}
+        for chat_id, title, created in conn.execute(
+                "SELECT id, title, created FROM sessions ORDER BY created"):
+            sessions[chat_id] = {'title': title, 'created': created, 'messages': []}
+        for chat_id, role, content, sources_json in conn.execute(
+                "SELECT session_id, role, content, sources_json FROM messages "
+                "ORDER BY session_id, idx"):
+            if chat_id in sessions:
+                msg = {'role': role, 'content': content}
+                if sources_json:
+                    msg['sources'] = json.loads(sources_json)
+                sessions[chat_id]['messages'].append(msg)
+        for chat_id, name, content in conn.execute(
+                "SELECT session_id, name, content FROM documents"):
+            if chat_id in sessions:
+                sessions[chat_id].setdefault('documents', {})[name] = content
+        return sessions
+    except:
+        return {}
+
+# One alternation scan replaces five sequential substring passes
+_TITLE_RE = re.compile(r'\b(how many|invoice|payment|check|payable)\b', re.IGNORECASE)
+_TITLE_MAP = {
+    'how many': "SOP Count Query",
+    'invoice': "Invoice Process",
+    'payment': "Payment Procedures",
+    'check': "Check Process",
+    'payable': "Accounts Payable"
+}
+
 def generate_chat_title(message: str) -> str:
-    msg = message.lower()
-    if "how many" in msg: return "SOP Count Query"
-    elif "invoice" in msg: return "Invoice Process"
-    elif "payment" in msg: return "Payment Procedures"
-    elif "check" in msg: return "Check Process"
-    elif "payable" in msg: return "Accounts Payable"
-    else: return " ".join(message.split()[:4]) + "..."
+    match = _TITLE_RE.search(message)
+    if match:
+        return _TITLE_MAP[match.group(1).lower()]
+    return " ".join(message.split()[:4]) + "..."
 
 def main():
     st.set_page_config(
@@ -289,15 +652,11 @@ def main():
             }
             st.session_state.current_chat_id = chat_id
     
-    # Get stats
+    # Get stats (cached — a fresh client plus full metadata scan per rerun
+    # grows linearly with the collection)
     try:
-        collection = chromadb.PersistentClient(path="./chroma_db").get_or_create_collection("sop_documents")
-        chunk_count = collection.count()
-        if chunk_count > 0:
-            metadata = collection.get(include=['metadatas'])
-            sop_count = len(set(m.get('source', '') for m in metadata['metadatas']))
-        else:
-            sop_count = 0
+        chunk_count = get_chroma_collection().count()
+        sop_count = count_unique_sources(chunk_count) if chunk_count > 0 else 0
     except:
         sop_count = 0
     
@@ -319,7 +678,7 @@ def main():
                 'created': datetime.now().isoformat()
             }
             st.session_state.current_chat_id = chat_id
-            save_chat_sessions(st.session_state.chat_sessions)
+            save_session_meta(chat_id, st.session_state.chat_sessions[chat_id])
             st.rerun()
         
         st.divider()
@@ -427,42 +786,62 @@ def main():
             uploaded_context = ""
             uploaded_file_name = ""
             document_sources = []
-            
+
+            # Start extraction in the background; the SOP search below runs
+            # concurrently, so the turn costs max(extract, search) not the sum
+            extract_future = None
             if uploaded_file:
-                with st.spinner("Processing uploaded document..."):
-                    uploaded_context = st.session_state.assistant.extract_text_from_file(uploaded_file)
-                    uploaded_file_name = uploaded_file.name
-                    
-                    # Store document in chat session for future reference
-                    if 'documents' not in current_chat:
-                        current_chat['documents'] = {}
-                    current_chat['documents'][uploaded_file_name] = uploaded_context
-                    
-                    # Add document info to sources
-                    document_sources = [{
-                        'text': uploaded_context[:500] + "..." if len(uploaded_context) > 500 else uploaded_context,
-                        'metadata': {'source': uploaded_file_name, 'type': 'uploaded_document'},
-                        'similarity': 1.0
-                    }]
-            
+                uploaded_file_name = uploaded_file.name
+                extract_future = _extract_pool().submit(
+                    st.session_state.assistant.extract_text_from_file, uploaded_file
+                )
+
+            # Dispatch retrieval now as well: the embed + HNSW query runs while
+            # the user message is appended and persisted below, so by the time
+            # the OpenAI request is built the chunks are usually already in
+            search_future = _extract_pool().submit(
+                st.session_state.assistant.search_sops, prompt
+            )
+
             # Add user message
             user_display_content = prompt
             if uploaded_file_name:
                 user_display_content = f"{prompt}\n\n📎 **Attached:** {uploaded_file_name}"
-            
+
             current_chat['messages'].append({"role": "user", "content": user_display_content})
-            
+
             # Update title if first message
             if len(current_chat['messages']) == 1:
                 current_chat['title'] = generate_chat_title(prompt)
-            
-            save_chat_sessions(st.session_state.chat_sessions)
-            
+                save_session_meta(st.session_state.current_chat_id, current_chat)
+
+            append_message(st.session_state.current_chat_id,
+                           len(current_chat['messages']) - 1,
+                           current_chat['messages'][-1])
+
             # Generate response
             with st.spinner("Generating response..."):
-                # Search SOPs for relevant content
-                sop_chunks = st.session_state.assistant.search_sops(prompt)
-                
+                # Collect the retrieval dispatched before persistence
+                sop_chunks = search_future.result()
+
+                if extract_future is not None:
+                    uploaded_context = extract_future.result()
+
+                    # Store document in chat session for future reference
+                    if 'documents' not in current_chat:
+                        current_chat['documents'] = {}
+                    doc_ref = store_upload(uploaded_context)
+                    current_chat['documents'][uploaded_file_name] = doc_ref
+                    save_document(st.session_state.current_chat_id, uploaded_file_name,
+                                  json.dumps(doc_ref))
+
+                    # Add document info to sources
+                    document_sources = [{
+                        'text': uploaded_context[:500] + "..." if len(uploaded_context) > 500 else uploaded_context,
+                        'metadata': {'source': uploaded_file_name, 'type': 'uploaded_document'},
+                        'similarity': 1.0
+                    }]
+
                 # Combine SOP chunks with document sources
                 all_sources = document_sources + sop_chunks
                 
@@ -473,13 +852,23 @@ def main():
                 response_placeholder = st.empty()
                 full_response = ""
                 
-                for token in st.session_state.assistant.stream_response(ai_prompt, st.session_state.selected_model):
+                # Each placeholder update re-ships the whole accumulated HTML,
+                # so flushing every token costs O(tokens^2) bytes; every 8th is
+                # still far above perceptible streaming granularity
+                for i, token in enumerate(st.session_state.assistant.stream_response(ai_prompt, st.session_state.selected_model)):
                     full_response += token
-                    response_placeholder.markdown(f"""
-                    <div class="assistant-message">
-                        <strong>SOP Assistant:</strong> {full_response}▌
-                    </div>
-                    """, unsafe_allow_html=True)
+                    if i % 8 == 0:
+                        response_placeholder.markdown(f"""
+                        <div class="assistant-message">
+                            <strong>SOP Assistant:</strong> {full_response}▌
+                        </div>
+                        """, unsafe_allow_html=True)
+
+                response_placeholder.markdown(f"""
+                <div class="assistant-message">
+                    <strong>SOP Assistant:</strong> {full_response}
+                </div>
+                """, unsafe_allow_html=True)
                 
                 # Add assistant response
                 current_chat['messages'].append({
@@ -487,8 +876,10 @@ def main():
                     "content": full_response,
                     "sources": all_sources
                 })
-            
-            save_chat_sessions(st.session_state.chat_sessions)
+
+            append_message(st.session_state.current_chat_id,
+                           len(current_chat['messages']) - 1,
+                           current_chat['messages'][-1])
             st.rerun()
     
     st.markdown('</div>', unsafe_allow_html=True)
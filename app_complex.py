@@ -5,26 +5,63 @@ Clean, minimal, and elegant interface following Apple's design principles
 """
 
 import os
+
+# Pin BLAS/OpenMP pools before torch gets imported downstream; oversubscribed
+# threads are a common cause of slow CPU encodes. Leave one core for Streamlit.
+_ENCODE_THREADS = str(max(1, (os.cpu_count() or 2) - 1))
+os.environ.setdefault('OMP_NUM_THREADS', _ENCODE_THREADS)
+os.environ.setdefault('MKL_NUM_THREADS', _ENCODE_THREADS)
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+import re
 import streamlit as st
 from pathlib import Path
 import time
-from sentence_transformers import SentenceTransformer
+from functools import lru_cache
+import numpy as np
+from onnx_encoder import create_encoder
 from typing import List, Dict
+import asyncio
+import hashlib
+import threading
 import json
+import secrets
+import tempfile
+import shutil
 from datetime import datetime
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI
 import docx
 import PyPDF2
 import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from sop_fetcher import SOPFetcher
 
-# Fix for ChromaDB SQLite version issue
-__import__('pysqlite3')
+# pypdf is the maintained PyPDF2 fork with noticeably faster extract_text
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# Fix for ChromaDB SQLite version issue — only swap in pysqlite3 when the
+# system sqlite is older than Chroma's minimum, skipping the extra lib load
+import sqlite3
 import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+if sqlite3.sqlite_version_info < (3, 35, 0):
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
 import chromadb
 
+# Cosine space on unit vectors reduces each distance to a dot product;
+# M/ef values follow the usual tuned-HNSW recommendations for this scale
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100
+}
+
 # Load environment variables
 try:
     from dotenv import load_dotenv
@@ -32,33 +69,277 @@ try:
 except ImportError:
     pass
 
+# orjson serializes ~5-10x faster than stdlib json; fall back if unavailable
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Single compiled scan instead of four lower-case + substring passes per query
+_COUNT_RE = re.compile(r'\b(?:how many|total count|number of sop|count of sop)\b', re.IGNORECASE)
+
+# Page count above which PDF extraction fans out to worker processes
+_PARALLEL_PDF_PAGES = 20
+
+# Tokenizer and temporal-reference matcher for "that document from earlier" lookups
+_WORD_RE = re.compile(r'\w+')
+_TEMPORAL_RE = re.compile(r'\b(?:earlier|previous|from before)\b')
+
+# Single compiled scan instead of several Python-level substring passes
+_SOP_KEYWORDS_RE = re.compile(r'\b(?:sop|standard operating|procedure|database|all documents)\b', re.IGNORECASE)
+
+# Static sidebar chrome — built once at import instead of on every rerun
+_MODEL_OPTIONS = {
+    "GPT-4o": "gpt-4o",
+    "GPT-4o-mini": "gpt-4o-mini",
+    "GPT-4 Turbo": "gpt-4-turbo",
+    "GPT-3.5 Turbo": "gpt-3.5-turbo"
+}
+_MODEL_NAMES = list(_MODEL_OPTIONS.keys())
+_MODEL_IDS = list(_MODEL_OPTIONS.values())
+_MODEL_NAME_BY_ID = {model_id: name for name, model_id in _MODEL_OPTIONS.items()}
+
+_SUGGESTIONS = [
+    ("📊 How many SOPs do we have?", "q1", "Get SOP count", "How many SOPs do we have?"),
+    ("💳 How do I process an invoice?", "q2", "Invoice procedures", "How do I process an invoice?"),
+    ("💰 What are payment procedures?", "q3", "Payment process", "What are payment procedures?"),
+    ("📋 Show accounts payable process", "q4", "AP process", "Show accounts payable process"),
+]
+
+def _doc_entry(doc_name: str, text: str) -> Dict:
+    """Session-document record with name tokens and source preview precomputed"""
+    return {
+        'text': text,
+        'tokens': sorted(set(_WORD_RE.findall(doc_name.lower()))),
+        'preview': text[:500] + ('...' if len(text) > 500 else '')
+    }
+
+def _doc_text(entry) -> str:
+    """Read a session document's text, tolerating the legacy plain-string form"""
+    return entry['text'] if isinstance(entry, dict) else entry
+
+def _doc_preview(entry) -> str:
+    """Cached 500-char preview, sliced on the fly for legacy entries"""
+    if isinstance(entry, dict) and 'preview' in entry:
+        return entry['preview']
+    text = _doc_text(entry)
+    return text[:500] + ('...' if len(text) > 500 else '')
+
+def _doc_tokens(doc_name: str, entry) -> frozenset:
+    """Name tokens for a session document, computed on the fly for legacy entries"""
+    if isinstance(entry, dict) and 'tokens' in entry:
+        return frozenset(entry['tokens'])
+    return frozenset(_WORD_RE.findall(doc_name.lower()))
+
+# One parsed reader per worker process, keyed on the temp-file path: page
+# tasks then pickle only (path, index) instead of the whole PDF per task
+_PDF_WORKER_READER = None
+
+def _extract_pdf_page(args):
+    """Extract one page's text from a PDF on disk; top-level so it pickles for subprocesses"""
+    global _PDF_WORKER_READER
+    pdf_path, index = args
+    if _PDF_WORKER_READER is None or _PDF_WORKER_READER[0] != pdf_path:
+        _PDF_WORKER_READER = (pdf_path, pypdf.PdfReader(pdf_path))
+    return _PDF_WORKER_READER[1].pages[index].extract_text() or ""
+
+# Prompt templates are built once at import; generate_response only fills the slots
+_PROMPT_BOTH = """{conv}You are a professional SOP assistant with access to uploaded documents and SOP database. 
+
+Current question: "{q}"
+
+{ctx}
+
+Instructions:
+1. Consider the conversation history above when answering
+2. Provide EXTREMELY comprehensive, detailed responses (aim for 500-2000+ words - be thorough!)
+3. If uploaded documents are available, prioritize them but also reference SOPs when relevant
+4. Give specific examples, step-by-step guidance, and practical implementation details
+5. Reference specific documents you're using and quote relevant sections
+6. If this is a follow-up question, acknowledge previous context and build upon it extensively
+7. Include background information, context, best practices, and potential pitfalls
+8. Use multiple sections, bullet points, numbered lists, and detailed explanations"""
+
+_PROMPT_UPLOADED = """{conv}You are analyzing {doc_count} uploaded {doc_text}.
+
+Current question: "{q}"
+
+{ctx}
+
+Instructions:
+1. Consider the conversation history above when answering
+2. Provide EXTREMELY comprehensive, detailed analysis (aim for 500-2000+ words - be thorough!)
+3. Analyze the uploaded {doc_text} thoroughly with deep insights
+4. Give specific details, examples, and quotes from the documents
+5. If this is a follow-up question, build upon previous responses extensively
+6. Structure your response with clear headings, bullet points, and multiple sections
+7. Include context, implications, best practices, and actionable recommendations
+8. Provide detailed explanations and comprehensive coverage of all relevant aspects"""
+
+_PROMPT_SOPS = """{conv}You are a professional SOP assistant.
+
+Current question: "{q}"
+
+{ctx}
+
+Instructions:
+1. Consider the conversation history above when answering
+2. Provide EXTREMELY comprehensive, detailed responses (aim for 500-2000+ words - be thorough!)
+3. Give specific step-by-step procedures with detailed explanations
+4. Reference the SOP documents you're using and quote relevant sections
+5. If this is a follow-up question, acknowledge and build upon previous context extensively
+6. Include practical examples, tips, best practices, and potential challenges
+7. Provide background context, detailed explanations, and comprehensive coverage
+8. Use multiple sections, bullet points, and structured formatting for clarity"""
+
+_PROMPT_GENERAL = """{conv}You are a professional SOP assistant.
+
+Current question: "{q}"
+
+Instructions:
+1. Consider the conversation history above when answering
+2. Provide helpful guidance based on general SOP best practices
+3. Give EXTREMELY comprehensive responses (aim for 500-2000+ words - be thorough!)
+4. If this is a follow-up question, acknowledge previous context extensively
+5. Include detailed explanations, best practices, and comprehensive guidance
+6. Use multiple sections, examples, and structured formatting for clarity
+7. Ask clarifying questions if needed, but provide extensive information regardless"""
+
+@st.cache_resource
+def get_chroma_client():
+    """Open the persistent Chroma client once per process"""
+    return chromadb.PersistentClient(path="./chroma_db")
+
+# One pool of warm HTTP/2 connections shared by all sessions; keepalive reuse
+# skips the TLS handshake on each turn and HTTP/2 multiplexes concurrent streams
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+@st.cache_resource
+def get_openai_client():
+    """Build a single OpenAI client shared across sessions"""
+    api_key = st.secrets.get("OPENAI_API_KEY", os.environ.get('OPENAI_API_KEY'))
+    return OpenAI(
+        api_key=api_key,
+        http_client=httpx.Client(http2=True, limits=_HTTP_LIMITS, timeout=60.0)
+    )
+
+@st.cache_resource
+def get_async_openai_client():
+    """Async client used for streaming so generation doesn't block the server thread"""
+    api_key = st.secrets.get("OPENAI_API_KEY", os.environ.get('OPENAI_API_KEY'))
+    return AsyncOpenAI(
+        api_key=api_key,
+        http_client=httpx.AsyncClient(http2=True, limits=_HTTP_LIMITS, timeout=60.0)
+    )
+
+@st.cache_resource
+def _stream_loop():
+    """One persistent event loop, on its own thread, for all async streaming.
+
+    The shared AsyncOpenAI client's keepalive pool binds to whichever loop
+    its connections were opened on; running every stream here keeps the pool
+    alive across turns and keeps concurrent sessions off each other's loops.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# On-disk copy of the transformer weights used for mmap-backed loading
+_MODEL_STATE_CACHE = Path("./model_cache/minilm_state.pt")
+
+def _mmap_model_weights(model):
+    """Re-back torch weights with a memory-mapped on-disk file.
+
+    With mmap=True the weights are demand-paged from one file through the OS
+    page cache, so multi-worker deployments share a single ~90MB copy instead
+    of each worker holding its own.
+    """
+    try:
+        import torch
+        if _MODEL_STATE_CACHE.exists():
+            state = torch.load(_MODEL_STATE_CACHE, map_location='cpu', mmap=True)
+            model.load_state_dict(state, assign=True)
+        else:
+            _MODEL_STATE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            torch.save(model.state_dict(), _MODEL_STATE_CACHE)
+    except Exception:
+        # ONNX backend, or torch too old for mmap/assign — weights stay in-process
+        pass
+    return model
+
+@st.cache_resource
+def get_embedding_model():
+    """Load the embedding model once and share it across all sessions"""
+    model = _mmap_model_weights(create_encoder())
+    try:
+        import torch
+        torch.set_num_threads(int(_ENCODE_THREADS))
+        torch.set_num_interop_threads(2)
+    except (ImportError, RuntimeError):
+        # interop threads can only be set before torch's pool starts; harmless to skip
+        pass
+    return model
+
+@st.cache_resource
+def _encode_cached():
+    """Process-wide query-embedding cache so repeat questions skip the forward pass.
+
+    Streamlit re-executes this script on every interaction, so a module-level
+    lru_cache would be rebuilt (empty) each rerun; cache_resource keeps one
+    cache alive for the process. Cached as float16: for normalized MiniLM
+    vectors the precision loss is negligible and the cache footprint halves.
+    """
+    @lru_cache(maxsize=512)
+    def encode(text: str) -> bytes:
+        embedding = get_embedding_model().encode(text, normalize_embeddings=True)
+        return embedding.astype(np.float16).tobytes()
+    return encode
+
 class SOPAssistant:
     def __init__(self):
-        # Get API key from Streamlit secrets or environment
-        api_key = st.secrets.get("OPENAI_API_KEY", os.environ.get('OPENAI_API_KEY'))
-        self.openai_client = OpenAI(api_key=api_key)
-        if 'embedding_model' not in st.session_state:
-            st.session_state.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.embedding_model = st.session_state.embedding_model
-        self.chroma_client = chromadb.PersistentClient(path="./chroma_db")
-        self.collection = self.chroma_client.get_or_create_collection("sop_documents")
+        self.openai_client = get_openai_client()
+        self.async_client = get_async_openai_client()
+        self.embedding_model = get_embedding_model()
+        self.chroma_client = get_chroma_client()
+        self.collection = self.chroma_client.get_or_create_collection(
+            "sop_documents",
+            metadata=COLLECTION_METADATA
+        )
     
     def extract_text_from_file(self, uploaded_file):
         """Extract text from uploaded document"""
         try:
             if uploaded_file.type == "application/pdf":
-                pdf_reader = PyPDF2.PdfReader(io.BytesIO(uploaded_file.read()))
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-                return text
-            
+                if pypdf is not None:
+                    reader = pypdf.PdfReader(uploaded_file)
+                    n_pages = len(reader.pages)
+                    if n_pages > _PARALLEL_PDF_PAGES:
+                        # Page decoding is CPU-bound pure Python; fan large PDFs
+                        # out across processes and rejoin in page order. The
+                        # bytes go over a temp file so each page task ships a
+                        # short path, not the whole document
+                        uploaded_file.seek(0)
+                        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+                            shutil.copyfileobj(uploaded_file, tmp)
+                            pdf_path = tmp.name
+                        try:
+                            parts = list(_pdf_pool().map(
+                                _extract_pdf_page,
+                                [(pdf_path, i) for i in range(n_pages)],
+                                chunksize=4
+                            ))
+                        finally:
+                            os.unlink(pdf_path)
+                        return "\n".join(parts)
+                    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+                # UploadedFile is already file-like, so skip the full read() + BytesIO copy
+                pdf_reader = PyPDF2.PdfReader(uploaded_file)
+                return "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
+
             elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                doc = docx.Document(io.BytesIO(uploaded_file.read()))
-                text = ""
-                for paragraph in doc.paragraphs:
-                    text += paragraph.text + "\n"
-                return text
+                doc = docx.Document(uploaded_file)
+                return "\n".join(paragraph.text for paragraph in doc.paragraphs)
             
             elif uploaded_file.type == "text/plain":
                 return str(uploaded_file.read(), "utf-8")
@@ -68,168 +349,485 @@ class SOPAssistant:
         except Exception as e:
             return f"Error reading file: {str(e)}"
     
+    def embed_chunks(self, chunks: List[str]) -> np.ndarray:
+        """Embed document chunks in one batched call, length-sorted to minimize padding waste"""
+        if not chunks:
+            return np.empty((0, 384), dtype=np.float32)
+
+        order = np.argsort([len(chunk) for chunk in chunks])
+        embeddings = self.embedding_model.encode(
+            [chunks[i] for i in order],
+            batch_size=32,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        # Un-sort so rows line up with the caller's chunk order
+        return np.asarray(embeddings, dtype=np.float32)[np.argsort(order)]
+
     def search_sops(self, query: str) -> List[Dict]:
         try:
-            embedding = self.embedding_model.encode(query)
+            # Collapse whitespace/case so trivial variants hit the same cache entry
+            normalized_query = ' '.join(query.lower().split())
+            embedding = np.frombuffer(_encode_cached()(normalized_query), dtype=np.float16).astype(np.float32)
             results = self.collection.query(
                 query_embeddings=[embedding.tolist()],
                 n_results=5,
                 include=['documents', 'metadatas', 'distances']
             )
             
+            # Collection is cosine-space, so distance is cosine distance and
+            # 1 - distance is a true cosine similarity
+            docs = results['documents'][0]
+            metas = results['metadatas'][0]
+            dists = results['distances'][0]
             return [{
-                'text': results['documents'][0][i],
-                'metadata': results['metadatas'][0][i],
-                'similarity': 1 - results['distances'][0][i]
-            } for i in range(len(results['documents'][0]))]
-        except:
+                'text': text,
+                'metadata': metadata,
+                'similarity': 1.0 - distance
+            } for text, metadata, distance in zip(docs, metas, dists)]
+        except Exception:
             return []
-    
+
     def generate_response(self, query: str, chunks: List[Dict], uploaded_context: str = "", total_sops: int = 0, conversation_history: List[Dict] = None):
-        context = ""
-        
+        # Assemble context through one buffer so each chunk is sliced exactly once
+        # and no intermediate concatenated strings are allocated
+        buf = io.StringIO()
+
         # Add uploaded document context first (higher priority)
         if uploaded_context:
-            context += f"UPLOADED DOCUMENTS FROM USER:\n{uploaded_context[:12000]}\n\n"
-        
+            buf.write("UPLOADED DOCUMENTS FROM USER:\n")
+            buf.write(uploaded_context[:12000])
+            buf.write("\n\n")
+
         # Add SOP context (expand context size)
         if chunks:
-            context += "SOP DATABASE DOCUMENTS:\n" + "\n\n".join([
-                f"Document: {chunk['metadata']['source']}\n{chunk['text'][:800]}"
-                for chunk in chunks[:5]
-            ])
+            buf.write("SOP DATABASE DOCUMENTS:\n")
+            for chunk in chunks[:5]:
+                buf.write("Document: ")
+                buf.write(chunk['metadata']['source'])
+                buf.write("\n")
+                buf.write(chunk['text'][:800])
+                buf.write("\n\n")
+
+        context = buf.getvalue()
         
         # Check if query is asking for total count
-        if any(phrase in query.lower() for phrase in ["how many", "total count", "number of sop", "count of sop"]) and total_sops > 0:
+        if total_sops > 0 and _COUNT_RE.search(query):
             context = f"IMPORTANT: The total number of SOPs in the system is {total_sops}.\n\n" + context
         
-        # Build conversation context
+        # Build conversation context in one pass; += on strings reallocates every turn
         conversation_context = ""
-        if conversation_history and len(conversation_history) > 0:
-            conversation_context = "PREVIOUS CONVERSATION CONTEXT:\n"
+        if conversation_history:
+            parts = ["PREVIOUS CONVERSATION CONTEXT:\n"]
             # Include last 4 messages (2 exchanges) for context
-            recent_messages = conversation_history[-4:] if len(conversation_history) > 4 else conversation_history
-            for msg in recent_messages:
+            for msg in conversation_history[-4:]:
                 role = "User" if msg["role"] == "user" else "Assistant"
-                content = msg["content"][:600] + "..." if len(msg["content"]) > 600 else msg["content"]
-                conversation_context += f"{role}: {content}\n\n"
-            conversation_context += "---\n\n"
+                content = msg["content"]
+                if len(content) > 600:
+                    content = content[:600] + "..."
+                parts.append(f"{role}: {content}\n\n")
+            parts.append("---\n\n")
+            conversation_context = ''.join(parts)
         
-        # Create comprehensive prompt
+        # Create comprehensive prompt from the precompiled templates
         if uploaded_context and chunks:
-            prompt = f"""{conversation_context}You are a professional SOP assistant with access to uploaded documents and SOP database. 
-
-Current question: "{query}"
+            prompt = _PROMPT_BOTH.format(conv=conversation_context, q=query, ctx=context)
 
-{context}
-
-Instructions:
-1. Consider the conversation history above when answering
-2. Provide EXTREMELY comprehensive, detailed responses (aim for 500-2000+ words - be thorough!)
-3. If uploaded documents are available, prioritize them but also reference SOPs when relevant
-4. Give specific examples, step-by-step guidance, and practical implementation details
-5. Reference specific documents you're using and quote relevant sections
-6. If this is a follow-up question, acknowledge previous context and build upon it extensively
-7. Include background information, context, best practices, and potential pitfalls
-8. Use multiple sections, bullet points, numbered lists, and detailed explanations"""
-        
         elif uploaded_context:
             doc_count = uploaded_context.count("=== DOCUMENT")
             doc_text = "documents" if doc_count > 1 else "document"
-            
-            prompt = f"""{conversation_context}You are analyzing {doc_count} uploaded {doc_text}.
-
-Current question: "{query}"
 
-{context}
+            prompt = _PROMPT_UPLOADED.format(
+                conv=conversation_context, q=query, ctx=context,
+                doc_count=doc_count, doc_text=doc_text
+            )
 
-Instructions:
-1. Consider the conversation history above when answering
-2. Provide EXTREMELY comprehensive, detailed analysis (aim for 500-2000+ words - be thorough!)
-3. Analyze the uploaded {doc_text} thoroughly with deep insights
-4. Give specific details, examples, and quotes from the documents
-5. If this is a follow-up question, build upon previous responses extensively
-6. Structure your response with clear headings, bullet points, and multiple sections
-7. Include context, implications, best practices, and actionable recommendations
-8. Provide detailed explanations and comprehensive coverage of all relevant aspects"""
-        
         elif chunks:
-            prompt = f"""{conversation_context}You are a professional SOP assistant.
+            prompt = _PROMPT_SOPS.format(conv=conversation_context, q=query, ctx=context)
 
-Current question: "{query}"
+        else:
+            prompt = _PROMPT_GENERAL.format(conv=conversation_context, q=query)
 
-{context}
+        return prompt
 
-Instructions:
-1. Consider the conversation history above when answering
-2. Provide EXTREMELY comprehensive, detailed responses (aim for 500-2000+ words - be thorough!)
-3. Give specific step-by-step procedures with detailed explanations
-4. Reference the SOP documents you're using and quote relevant sections
-5. If this is a follow-up question, acknowledge and build upon previous context extensively
-6. Include practical examples, tips, best practices, and potential challenges
-7. Provide background context, detailed explanations, and comprehensive coverage
-8. Use multiple sections, bullet points, and structured formatting for clarity"""
-        
-        else:
-            prompt = f"""{conversation_context}You are a professional SOP assistant.
+    async def _astream(self, messages: List[Dict], model: str):
+        """Async streaming core; lets the event loop service other work between deltas"""
+        # Set max tokens based on model
+        max_tokens = 16000 if "gpt-4o" in model else 4000  # Max out the tokens
 
-Current question: "{query}"
+        stream = await self.async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            temperature=0.3,
+            max_tokens=max_tokens,  # Maxed out token limit
+            top_p=0.9,
+            stream_options={"include_usage": False}
+        )
 
-Instructions:
-1. Consider the conversation history above when answering
-2. Provide helpful guidance based on general SOP best practices
-3. Give EXTREMELY comprehensive responses (aim for 500-2000+ words - be thorough!)
-4. If this is a follow-up question, acknowledge previous context extensively
-5. Include detailed explanations, best practices, and comprehensive guidance
-6. Use multiple sections, examples, and structured formatting for clarity
-7. Ask clarifying questions if needed, but provide extensive information regardless"""
-        
-        return prompt
+        # Coalesce deltas so each yield maps to one frontend update, not one token
+        buffer = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                buffer.append(chunk.choices[0].delta.content)
+                if len(buffer) >= 6:
+                    yield ''.join(buffer)
+                    buffer.clear()
+        if buffer:
+            yield ''.join(buffer)
 
     def stream_response(self, messages: List[Dict], model: str = "gpt-4o-mini"):
+        """Sync generator bridge over the async stream for the Streamlit render loop"""
+        # All streams run on the one persistent loop: the shared async
+        # client's keepalive pool binds to the loop it first runs on, so a
+        # per-call loop would strand those connections the moment it closed
+        loop = _stream_loop()
+        agen = self._astream(messages, model)
         try:
-            # Set max tokens based on model
-            max_tokens = 16000 if "gpt-4o" in model else 4000  # Max out the tokens
-            
-            stream = self.openai_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                stream=True,
-                temperature=0.3,
-                max_tokens=max_tokens,  # Maxed out token limit
-                top_p=0.9
-            )
-            
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(
+                        agen.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    break
         except Exception as e:
             yield f"Error: {str(e)}"
+        finally:
+            try:
+                asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result(timeout=5)
+            except Exception:
+                pass
 
-def load_chat_sessions():
+@st.cache_data(show_spinner=False)
+def _load_css() -> str:
+    """Read the static stylesheet once so ~18KB of CSS isn't re-parsed every rerun"""
+    return Path("assets/styles.css").read_text()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_sop_stats(chunk_count: int) -> int:
+    """Count unique SOP sources; cached so the full metadata scan only reruns when chunks change"""
+    collection = get_chroma_client().get_or_create_collection("sop_documents")
+    metadata = collection.get(include=['metadatas'])
+    return len(set(m.get('source', '') for m in metadata['metadatas']))
+
+@st.cache_resource(show_spinner=False)
+def _executor() -> ThreadPoolExecutor:
+    """Small shared pool for overlapping I/O-bound work within a turn"""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource(show_spinner=False)
+def _pdf_pool() -> ProcessPoolExecutor:
+    """Shared worker processes for large-PDF page extraction; spawning a fresh
+    pool per upload costs more than the parallelism saves"""
+    return ProcessPoolExecutor()
+
+@st.cache_resource(show_spinner=False)
+def _sop_fetcher() -> SOPFetcher:
+    """One fetcher (and thus one Chroma client/embedding model) per process"""
+    return SOPFetcher()
+
+def _initial_sop_count() -> int:
+    """Unique-source count persisted by the fetcher, with a one-time scan fallback"""
     try:
-        if Path("chat_sessions.json").exists():
-            with open("chat_sessions.json", 'r') as f:
-                return json.load(f)
-    except:
+        metadata_file = Path("sop_metadata.json")
+        if metadata_file.exists():
+            count = _loads(metadata_file.read_bytes()).get('unique_source_count')
+            if count is not None:
+                return count
+    except Exception:
         pass
-    return {}
+    try:
+        collection = st.session_state.assistant.collection
+        chunk_count = collection.count()
+        return get_sop_stats(chunk_count) if chunk_count > 0 else 0
+    except Exception:
+        return 0
+
+@st.cache_data(ttl=10, show_spinner=False)
+def _cached_fetch_status() -> dict:
+    """Memoize the sidebar status read so reruns don't re-stat the SOP directory"""
+    return _sop_fetcher().get_fetch_status()
+
+# Each chat lives in its own directory: meta.json holds everything except the
+# message log, messages.ndjson gets one appended line per message. A normal
+# send writes O(message) bytes instead of re-serializing any chat history.
+_CHATS_DIR = Path("chats")
+_LEGACY_SESSIONS_FILE = Path("chat_sessions.json")
+
+def _dumps(obj, indent=False):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2) if indent else orjson.dumps(obj)
+    if indent:
+        return json.dumps(obj, indent=2).encode()
+    return json.dumps(obj, separators=(',', ':')).encode()
 
-def save_chat_sessions(chat_sessions):
+def _loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def save_chat_meta(chat_id, chat):
+    """Atomically persist a chat's metadata (title, created, documents)"""
     try:
-        with open("chat_sessions.json", 'w') as f:
-            json.dump(chat_sessions, f, indent=2)
-    except:
+        chat_dir = _CHATS_DIR / chat_id
+        chat_dir.mkdir(parents=True, exist_ok=True)
+        meta = {k: v for k, v in chat.items() if k != 'messages'}
+        tmp_path = chat_dir / "meta.json.tmp"
+        tmp_path.write_bytes(_dumps(meta, indent=True))
+        os.replace(tmp_path, chat_dir / "meta.json")
+    except Exception:
         pass
 
+def append_message(chat_id, message):
+    """Append one message line to the chat's log; never rewrites history"""
+    try:
+        chat_dir = _CHATS_DIR / chat_id
+        chat_dir.mkdir(parents=True, exist_ok=True)
+        with open(chat_dir / "messages.ndjson", 'ab') as f:
+            f.write(_dumps(message) + b'\n')
+    except Exception:
+        pass
+
+def save_chat(chat_id, chat):
+    """Rewrite a chat in full — only needed when history is truncated or edited"""
+    save_chat_meta(chat_id, chat)
+    try:
+        chat_dir = _CHATS_DIR / chat_id
+        tmp_path = chat_dir / "messages.ndjson.tmp"
+        with open(tmp_path, 'wb') as f:
+            for message in chat.get('messages', []):
+                f.write(_dumps(message) + b'\n')
+        os.replace(tmp_path, chat_dir / "messages.ndjson")
+    except Exception:
+        pass
+
+def delete_chat(chat_id):
+    """Remove a chat's directory (and any pre-directory flat file) from disk"""
+    try:
+        shutil.rmtree(_CHATS_DIR / chat_id, ignore_errors=True)
+        (_CHATS_DIR / f"{chat_id}.json").unlink(missing_ok=True)
+    except Exception:
+        pass
+
+def load_chat_sessions():
+    """Load all chats, migrating older single-file layouts as they're found"""
+    sessions = {}
+    if _CHATS_DIR.exists():
+        for entry in sorted(_CHATS_DIR.iterdir()):
+            try:
+                if entry.is_dir() and (entry / "meta.json").exists():
+                    chat = _loads((entry / "meta.json").read_bytes())
+                    chat['messages'] = []
+                    messages_file = entry / "messages.ndjson"
+                    if messages_file.exists():
+                        for line in messages_file.read_bytes().splitlines():
+                            if line.strip():
+                                chat['messages'].append(_loads(line))
+                    sessions[entry.name] = chat
+                elif entry.suffix == '.json':
+                    # Flat per-chat file from before the directory layout
+                    chat = _loads(entry.read_bytes())
+                    sessions[entry.stem] = chat
+                    save_chat(entry.stem, chat)
+                    entry.unlink()
+            except Exception:
+                continue
+
+    if not sessions and _LEGACY_SESSIONS_FILE.exists():
+        # One-time migration from the old whole-corpus chat_sessions.json
+        try:
+            sessions = _loads(_LEGACY_SESSIONS_FILE.read_bytes())
+            for chat_id, chat in sessions.items():
+                save_chat(chat_id, chat)
+        except Exception:
+            sessions = {}
+
+    return sessions
+
+# One alternation scan replaces five sequential substring passes
+_TITLE_RE = re.compile(
+    r'(?P<count>how many)|(?P<invoice>invoice)|(?P<payment>payment)|(?P<check>check)|(?P<payable>payable)',
+    re.IGNORECASE
+)
+_TITLE_MAP = {
+    'count': "SOP Count Query",
+    'invoice': "Invoice Process",
+    'payment': "Payment Procedures",
+    'check': "Check Process",
+    'payable': "Accounts Payable"
+}
+
+def _new_chat_id() -> str:
+    """Session counter plus a short random suffix; time.time() ids collide
+    when two chats are created within the same second"""
+    seq = st.session_state.get('_chat_seq', 0) + 1
+    st.session_state['_chat_seq'] = seq
+    return f"chat_{seq}_{secrets.token_urlsafe(3)}"
+
 def generate_chat_title(message: str) -> str:
-    msg = message.lower()
-    if "how many" in msg: return "SOP Count Query"
-    elif "invoice" in msg: return "Invoice Process"
-    elif "payment" in msg: return "Payment Procedures"
-    elif "check" in msg: return "Check Process"
-    elif "payable" in msg: return "Accounts Payable"
-    else: return " ".join(message.split()[:4]) + "..."
+    match = _TITLE_RE.search(message)
+    if match:
+        return _TITLE_MAP[match.lastgroup]
+    return " ".join(message.split()[:4]) + "..."
+
+_SYSTEM_PROMPT = """You are a professional SOP assistant. Your responses should be:
+- EXTREMELY comprehensive and detailed (aim for 500-2000+ words - be as thorough as possible!)
+- Conversational and engaging, acknowledging previous context extensively
+- Well-structured with multiple clear headings, bullet points, numbered lists, and detailed examples
+- Practical with comprehensive step-by-step guidance and implementation details
+- Reference specific documents and sources, including relevant quotes
+- Build upon previous conversation context naturally and extensively
+- Include background information, context, best practices, potential pitfalls, and comprehensive explanations
+- Use detailed formatting with sections, subsections, and thorough coverage of all aspects
+- Never be brief - always provide maximum detail and comprehensive coverage"""
+
+# The system message never changes, so every turn shares one dict by reference
+_SYSTEM_MSG = {"role": "system", "content": _SYSTEM_PROMPT}
+
+def _build_messages(user_prompt: str) -> List[Dict]:
+    """Message array for a chat completion call"""
+    return [_SYSTEM_MSG, {"role": "user", "content": user_prompt}]
+
+def _run_streaming_turn(ai_prompt: str, model: str) -> str:
+    """Build the OpenAI message array and stream the reply into a placeholder"""
+    messages = _build_messages(ai_prompt)
+
+    response_placeholder = st.empty()
+    full_response = ""
+
+    # Flush at most every ~30ms: each placeholder update re-ships the whole
+    # accumulated HTML, so per-token flushes cost O(tokens^2) bytes on the wire
+    last_flush = time.monotonic()
+    for token in st.session_state.assistant.stream_response(messages, model):
+        full_response += token
+        now = time.monotonic()
+        if now - last_flush >= 0.03:
+            last_flush = now
+            response_placeholder.markdown(f"""
+            <div class="assistant-message">
+                <strong>SOP Assistant</strong><br>{full_response}▌
+            </div>
+            """, unsafe_allow_html=True)
+
+    response_placeholder.markdown(f"""
+    <div class="assistant-message">
+        <strong>SOP Assistant</strong><br>{full_response}
+    </div>
+    """, unsafe_allow_html=True)
+
+    return full_response
+
+@st.fragment
+def _sidebar_config():
+    """Model picker; fragment-scoped so typing in the chat doesn't redraw it"""
+    with st.container():
+        st.markdown("**🤖 AI Configuration**")
+        selected_model_name = st.selectbox(
+            "Model:",
+            options=_MODEL_NAMES,
+            index=_MODEL_IDS.index(st.session_state.selected_model),
+            label_visibility="collapsed"
+        )
+        st.session_state.selected_model = _MODEL_OPTIONS[selected_model_name]
+
+@st.fragment
+def _render_message(i, msg, current_chat, sop_count):
+    """Render one chat turn; editing a message reruns only this fragment"""
+    st.markdown('<div class="message-container">', unsafe_allow_html=True)
+    
+    if msg["role"] == "user":
+        # User message with edit functionality
+        col_msg, col_edit = st.columns([20, 1])
+        with col_msg:
+            st.markdown(f"""
+            <div class="user-message">
+                <strong>You</strong><br>{msg["content"]}
+            </div>
+            """, unsafe_allow_html=True)
+        with col_edit:
+            if st.button("✏️", key=f"edit_{i}", help="Edit message"):
+                st.session_state.editing_message = i
+                st.session_state.edit_content = msg["content"]
+                st.rerun()
+        
+        # Edit interface
+        if 'editing_message' in st.session_state and st.session_state.editing_message == i:
+            st.text_area("Edit your message:", 
+                       value=st.session_state.edit_content, 
+                       key=f"edit_text_{i}",
+                       height=100)
+            
+            col_save, col_cancel = st.columns(2)
+            with col_save:
+                if st.button("💾 Save", key=f"save_{i}"):
+                    new_content = st.session_state[f"edit_text_{i}"]
+                    if new_content.strip():
+                        # Update and regenerate
+                        current_chat['messages'][i]['content'] = new_content
+                        current_chat['messages'] = current_chat['messages'][:i+1]
+                        
+                        del st.session_state.editing_message
+                        del st.session_state.edit_content
+
+                        save_chat(st.session_state.current_chat_id, current_chat)
+                        
+                        # Regenerate response
+                        with st.spinner("Regenerating response..."):
+                            uploaded_context_edit = ""
+                            document_sources_edit = []
+                            
+                            sop_chunks = st.session_state.assistant.search_sops(new_content)
+                            all_sources_edit = document_sources_edit + sop_chunks
+                            
+                            # Get conversation history up to the edited message
+                            conversation_history_edit = current_chat['messages'][:i] if i > 0 else []
+                            
+                            ai_prompt = st.session_state.assistant.generate_response(
+                                new_content, sop_chunks, uploaded_context_edit, sop_count, conversation_history_edit
+                            )
+                            
+                            full_response = _run_streaming_turn(ai_prompt, st.session_state.selected_model)
+
+                            current_chat['messages'].append({
+                                "role": "assistant",
+                                "content": full_response,
+                                "sources": all_sources_edit,
+                                "unique_sources": list(dict.fromkeys(
+                                    s['metadata']['source'] for s in all_sources_edit
+                                ))
+                            })
+
+                        save_chat(st.session_state.current_chat_id, current_chat)
+                        st.rerun()
+            
+            with col_cancel:
+                if st.button("❌ Cancel", key=f"cancel_{i}"):
+                    del st.session_state.editing_message
+                    del st.session_state.edit_content
+                    st.rerun()
+    
+    else:
+        # Assistant message
+        st.markdown(f"""
+        <div class="assistant-message">
+            <strong>SOP Assistant</strong><br>{msg["content"]}
+        </div>
+        """, unsafe_allow_html=True)
+        
+        # Sources
+        source_names = msg.get("unique_sources")
+        if source_names is None and msg.get("sources"):
+            # Older chats stored raw chunks; dedupe them once here
+            source_names = list(dict.fromkeys(c['metadata']['source'] for c in msg["sources"]))
+        if source_names:
+            st.markdown("**📚 Source Documents:**")
+            for source_name in source_names:
+                st.markdown(f"""
+                <div class="source-card">
+                    📄 {source_name}
+                </div>
+                """, unsafe_allow_html=True)
+    
+    st.markdown('</div>', unsafe_allow_html=True)  # Close message-container
+
 
 def main():
     st.set_page_config(
@@ -239,584 +837,8 @@ def main():
         initial_sidebar_state="expanded"
     )
     
-    # Apple-inspired CSS styling
-    st.markdown("""
-    <style>
-    /* Import SF Pro font family (fallback to system fonts) */
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
-    
-    /* Reset and base styles */
-    * {
-        font-family: -apple-system, BlinkMacSystemFont, 'Inter', 'Segoe UI', Roboto, sans-serif;
-        -webkit-font-smoothing: antialiased;
-        -moz-osx-font-smoothing: grayscale;
-    }
-    
-    /* Hide Streamlit branding */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-    .stDeployButton {visibility: hidden;}
-    
-    /* Root variables (Apple-like color system) */
-    :root {
-        --primary-blue: #007AFF;
-        --primary-blue-hover: #0056CC;
-        --secondary-blue: #F0F8FF;
-        --gray-1: #F2F2F7;
-        --gray-2: #E5E5EA;
-        --gray-3: #D1D1D6;
-        --gray-4: #C7C7CC;
-        --gray-5: #AEAEB2;
-        --gray-6: #8E8E93;
-        --text-primary: #1D1D1F;
-        --text-secondary: #86868B;
-        --background: #FFFFFF;
-        --surface: #FBFBFD;
-        --border: rgba(0, 0, 0, 0.1);
-        --shadow-sm: 0 1px 3px rgba(0, 0, 0, 0.05);
-        --shadow-md: 0 4px 16px rgba(0, 0, 0, 0.1);
-        --shadow-lg: 0 8px 32px rgba(0, 0, 0, 0.12);
-        --radius-sm: 8px;
-        --radius-md: 12px;
-        --radius-lg: 16px;
-        --blur: blur(20px);
-    }
-    
-    /* App background */
-    .stApp {
-        background: var(--surface);
-        min-height: 100vh;
-    }
-    
-    /* Main container reset */
-    .main .block-container {
-        padding: 1rem 2rem !important;
-        padding-bottom: 120px !important;
-        margin: 0 !important;
-        max-width: none !important;
-        width: 100% !important;
-        background: none !important;
-    }
-    
-    /* Sidebar styling (Apple-like) */
-    [data-testid="stSidebar"] {
-        background: rgba(255, 255, 255, 0.8) !important;
-        backdrop-filter: var(--blur) !important;
-        border-right: 1px solid var(--border) !important;
-        box-shadow: var(--shadow-sm) !important;
-    }
-    
-    [data-testid="stSidebar"] > div:first-child {
-        background: transparent !important;
-        padding-top: 1rem !important;
-    }
-    
-    /* Typography system */
-    h1 {
-        font-size: 2.125rem !important;
-        font-weight: 700 !important;
-        line-height: 1.2 !important;
-        letter-spacing: -0.02em !important;
-        color: var(--text-primary) !important;
-        margin-bottom: 0.5rem !important;
-    }
-    
-    h2 {
-        font-size: 1.5rem !important;
-        font-weight: 600 !important;
-        line-height: 1.3 !important;
-        color: var(--text-primary) !important;
-        margin-bottom: 1rem !important;
-    }
-    
-    h3 {
-        font-size: 1.125rem !important;
-        font-weight: 600 !important;
-        line-height: 1.4 !important;
-        color: var(--text-primary) !important;
-        margin-bottom: 0.75rem !important;
-    }
-    
-    p, div, span, label {
-        color: var(--text-primary) !important;
-        font-size: 0.9375rem !important;
-        line-height: 1.5 !important;
-        font-weight: 400 !important;
-    }
-    
-    /* Header design */
-    .app-header {
-        background: rgba(255, 255, 255, 0.9);
-        backdrop-filter: var(--blur);
-        border-bottom: 1px solid var(--border);
-        padding: 1rem 2rem;
-        position: sticky;
-        top: 0;
-        z-index: 100;
-        margin-bottom: 0;
-    }
-    
-    .header-content {
-        max-width: 1200px;
-        margin: 0 auto;
-        text-align: center;
-    }
-    
-    .header-subtitle {
-        color: var(--text-secondary) !important;
-        font-size: 1rem !important;
-        font-weight: 400 !important;
-        margin-top: 0.25rem !important;
-    }
-    
-    /* Button system (Apple-like) */
-    .stButton > button {
-        background: var(--primary-blue) !important;
-        color: white !important;
-        border: none !important;
-        border-radius: var(--radius-sm) !important;
-        padding: 0.75rem 1.25rem !important;
-        font-weight: 500 !important;
-        font-size: 0.9375rem !important;
-        line-height: 1 !important;
-        transition: all 0.2s cubic-bezier(0.4, 0, 0.2, 1) !important;
-        box-shadow: var(--shadow-sm) !important;
-        cursor: pointer !important;
-        min-height: auto !important;
-        height: auto !important;
-    }
-    
-    .stButton > button:hover {
-        background: var(--primary-blue-hover) !important;
-        transform: translateY(-1px) !important;
-        box-shadow: var(--shadow-md) !important;
-    }
-    
-    .stButton > button:active {
-        transform: translateY(0) !important;
-        box-shadow: var(--shadow-sm) !important;
-    }
-    
-    /* Secondary buttons (chat history) */
-    .stButton > button[kind="secondary"] {
-        background: var(--background) !important;
-        color: var(--text-primary) !important;
-        border: 1px solid var(--gray-2) !important;
-        box-shadow: none !important;
-        text-align: left !important;
-    }
-    
-    .stButton > button[kind="secondary"]:hover {
-        background: var(--gray-1) !important;
-        border-color: var(--gray-3) !important;
-        transform: none !important;
-    }
-    
-    /* Primary button variant for active states */
-    .stButton > button[type="primary"] {
-        background: var(--primary-blue) !important;
-        color: white !important;
-        box-shadow: var(--shadow-md) !important;
-    }
-    
-    /* Chat message containers */
-    .chat-container {
-        max-width: 800px;
-        margin: 0 auto;
-        padding: 1rem 2rem;
-    }
-    
-    .message-container {
-        margin-bottom: 1.5rem;
-        animation: slideIn 0.3s cubic-bezier(0.4, 0, 0.2, 1);
-    }
-    
-    @keyframes slideIn {
-        from {
-            opacity: 0;
-            transform: translateY(10px);
-        }
-        to {
-            opacity: 1;
-            transform: translateY(0);
-        }
-    }
-    
-    /* User messages */
-    .user-message {
-        background: var(--primary-blue) !important;
-        color: white !important;
-        padding: 1rem 1.25rem !important;
-        border-radius: var(--radius-lg) var(--radius-lg) var(--radius-sm) var(--radius-lg) !important;
-        margin: 0 0 0 20% !important;
-        box-shadow: var(--shadow-md) !important;
-        position: relative !important;
-    }
-    
-    .user-message * {
-        color: white !important;
-    }
-    
-    /* Assistant messages */
-    .assistant-message {
-        background: var(--background) !important;
-        color: var(--text-primary) !important;
-        padding: 1rem 1.25rem !important;
-        border-radius: var(--radius-lg) var(--radius-lg) var(--radius-lg) var(--radius-sm) !important;
-        margin: 0 20% 0 0 !important;
-        box-shadow: var(--shadow-md) !important;
-        border: 1px solid var(--gray-2) !important;
-        position: relative !important;
-    }
-    
-    .assistant-message * {
-        color: var(--text-primary) !important;
-    }
-    
-    /* Welcome message */
-    .welcome-container {
-        background: var(--background);
-        border-radius: var(--radius-lg);
-        padding: 2rem;
-        margin: 2rem auto;
-        max-width: 600px;
-        text-align: center;
-        box-shadow: var(--shadow-md);
-        border: 1px solid var(--gray-2);
-    }
-    
-    .welcome-grid {
-        display: grid;
-        grid-template-columns: 1fr 1fr;
-        gap: 1rem;
-        margin-top: 1.5rem;
-    }
-    
-    .suggestion-button {
-        background: var(--gray-1) !important;
-        color: var(--text-primary) !important;
-        border: 1px solid var(--gray-3) !important;
-        border-radius: var(--radius-md) !important;
-        padding: 1rem !important;
-        font-weight: 500 !important;
-        transition: all 0.2s cubic-bezier(0.4, 0, 0.2, 1) !important;
-        text-align: left !important;
-        min-height: auto !important;
-        height: auto !important;
-    }
-    
-    .suggestion-button:hover {
-        background: var(--secondary-blue) !important;
-        border-color: var(--primary-blue) !important;
-        transform: translateY(-2px) !important;
-        box-shadow: var(--shadow-md) !important;
-    }
-    
-    /* Source cards */
-    .source-card {
-        background: var(--secondary-blue) !important;
-        border: 1px solid rgba(0, 122, 255, 0.2) !important;
-        border-radius: var(--radius-md) !important;
-        padding: 0.875rem 1rem !important;
-        margin: 0.5rem 0 !important;
-        color: var(--primary-blue) !important;
-        font-weight: 500 !important;
-        font-size: 0.875rem !important;
-        box-shadow: var(--shadow-sm) !important;
-        border-left: 3px solid var(--primary-blue) !important;
-    }
-    
-    .source-card * {
-        color: var(--primary-blue) !important;
-    }
-    
-    /* Input area */
-    .input-container {
-        position: fixed;
-        bottom: 0;
-        left: 0;
-        right: 0;
-        background: rgba(255, 255, 255, 0.95);
-        backdrop-filter: var(--blur);
-        border-top: 1px solid var(--border);
-        padding: 1rem 2rem 1.5rem;
-        z-index: 100;
-    }
-    
-    .input-inner {
-        max-width: 800px;
-        margin: 0 auto;
-    }
-    
-    /* File uploader styling */
-    .stFileUploader {
-        margin-bottom: 1rem !important;
-    }
-    
-    .stFileUploader > div {
-        background: var(--gray-1) !important;
-        border: 2px dashed var(--gray-4) !important;
-        border-radius: var(--radius-md) !important;
-        padding: 1rem !important;
-        text-align: center !important;
-        transition: all 0.2s cubic-bezier(0.4, 0, 0.2, 1) !important;
-    }
-    
-    .stFileUploader > div:hover {
-        background: var(--secondary-blue) !important;
-        border-color: var(--primary-blue) !important;
-    }
-    
-    .stFileUploader label {
-        color: var(--text-secondary) !important;
-        font-weight: 500 !important;
-        font-size: 0.875rem !important;
-    }
-    
-    /* Text area input */
-    .stTextArea > div > div > textarea {
-        background: var(--background) !important;
-        border: 2px solid var(--gray-3) !important;
-        border-radius: var(--radius-md) !important;
-        padding: 1rem !important;
-        font-size: 0.9375rem !important;
-        line-height: 1.5 !important;
-        color: var(--text-primary) !important;
-        resize: none !important;
-        transition: all 0.2s cubic-bezier(0.4, 0, 0.2, 1) !important;
-        box-shadow: var(--shadow-sm) !important;
-    }
-    
-    .stTextArea > div > div > textarea:focus {
-        border-color: var(--primary-blue) !important;
-        box-shadow: 0 0 0 3px rgba(0, 122, 255, 0.1) !important;
-        outline: none !important;
-    }
-    
-    .stTextArea > div > div > textarea::placeholder {
-        color: var(--text-secondary) !important;
-        font-weight: 400 !important;
-    }
-    
-    /* Sidebar chat list */
-    .chat-list-item {
-        margin-bottom: 0.5rem !important;
-    }
-    
-    .chat-list-item button {
-        width: 100% !important;
-        text-align: left !important;
-        padding: 0.75rem 1rem !important;
-        border-radius: var(--radius-md) !important;
-        font-size: 0.875rem !important;
-        font-weight: 500 !important;
-        white-space: nowrap !important;
-        overflow: hidden !important;
-        text-overflow: ellipsis !important;
-    }
-    
-    /* Metrics styling */
-    .stMetric {
-        background: var(--background) !important;
-        border-radius: var(--radius-md) !important;
-        padding: 1rem !important;
-        border: 1px solid var(--gray-2) !important;
-        box-shadow: var(--shadow-sm) !important;
-    }
-    
-    .stMetric > div {
-        text-align: center !important;
-    }
-    
-    .stMetric label {
-        color: var(--text-secondary) !important;
-        font-size: 0.75rem !important;
-        font-weight: 500 !important;
-        text-transform: uppercase !important;
-        letter-spacing: 0.05em !important;
-    }
-    
-    .stMetric > div > div {
-        color: var(--text-primary) !important;
-        font-size: 1.5rem !important;
-        font-weight: 700 !important;
-        margin-top: 0.25rem !important;
-    }
-    
-    /* Selectbox styling */
-    .stSelectbox > div > div {
-        background: var(--background) !important;
-        border: 1px solid var(--gray-3) !important;
-        border-radius: var(--radius-md) !important;
-        box-shadow: var(--shadow-sm) !important;
-    }
-    
-    .stSelectbox label {
-        color: var(--text-secondary) !important;
-        font-weight: 500 !important;
-        font-size: 0.875rem !important;
-        margin-bottom: 0.5rem !important;
-    }
-    
-    /* Success/info messages */
-    .stSuccess {
-        background: rgba(52, 199, 89, 0.1) !important;
-        color: #1B5E20 !important;
-        border: 1px solid rgba(52, 199, 89, 0.3) !important;
-        border-radius: var(--radius-md) !important;
-        padding: 1rem !important;
-        font-weight: 500 !important;
-    }
-    
-    .stInfo {
-        background: var(--secondary-blue) !important;
-        color: var(--primary-blue) !important;
-        border: 1px solid rgba(0, 122, 255, 0.3) !important;
-        border-radius: var(--radius-md) !important;
-        padding: 1rem !important;
-        font-weight: 500 !important;
-    }
-    
-    /* Edit button styling */
-    .edit-button {
-        background: var(--gray-1) !important;
-        color: var(--text-secondary) !important;
-        border: 1px solid var(--gray-3) !important;
-        border-radius: 50% !important;
-        width: 32px !important;
-        height: 32px !important;
-        padding: 0 !important;
-        font-size: 0.75rem !important;
-        margin-top: 0.5rem !important;
-    }
-    
-    .edit-button:hover {
-        background: var(--gray-2) !important;
-        color: var(--text-primary) !important;
-    }
-    
-    /* Delete/Clear buttons in sidebar */
-    [data-testid="stSidebar"] .stButton > button[key*="delete_"],
-    [data-testid="stSidebar"] .stButton > button[key="clear_all_chats"] {
-        background: transparent !important;
-        color: var(--text-secondary) !important;
-        border: 1px solid transparent !important;
-        padding: 0.25rem !important;
-        min-height: 32px !important;
-        font-size: 0.875rem !important;
-    }
-    
-    [data-testid="stSidebar"] .stButton > button[key*="delete_"]:hover,
-    [data-testid="stSidebar"] .stButton > button[key="clear_all_chats"]:hover {
-        background: rgba(255, 59, 48, 0.1) !important;
-        color: #FF3B30 !important;
-        border-color: rgba(255, 59, 48, 0.2) !important;
-    }
-    
-    /* Clear current chat button */
-    .stButton > button[key="clear_current_chat"] {
-        background: transparent !important;
-        color: var(--text-secondary) !important;
-        border: 1px solid var(--gray-3) !important;
-        padding: 0.5rem !important;
-        min-height: 36px !important;
-        font-size: 1rem !important;
-        float: right !important;
-    }
-    
-    .stButton > button[key="clear_current_chat"]:hover {
-        background: rgba(255, 59, 48, 0.1) !important;
-        color: #FF3B30 !important;
-        border-color: rgba(255, 59, 48, 0.2) !important;
-    }
-    
-    
-    /* Scrollable chat area */
-    .chat-messages {
-        max-height: calc(100vh - 250px);
-        overflow-y: auto;
-        padding-right: 0.5rem;
-    }
-    
-    /* Custom scrollbar */
-    .chat-messages::-webkit-scrollbar {
-        width: 6px;
-    }
-    
-    .chat-messages::-webkit-scrollbar-track {
-        background: var(--gray-1);
-        border-radius: 3px;
-    }
-    
-    .chat-messages::-webkit-scrollbar-thumb {
-        background: var(--gray-4);
-        border-radius: 3px;
-    }
-    
-    .chat-messages::-webkit-scrollbar-thumb:hover {
-        background: var(--gray-5);
-    }
-    
-    /* Hide Streamlit elements in sidebar */
-    .css-1y4p8pa {
-        padding-top: 1rem !important;
-    }
-    
-    /* Hide the form submit button completely */
-    [data-testid="stForm"] button {
-        display: none !important;
-    }
-    
-    [data-testid="stForm"] > div > div > div > div > button {
-        display: none !important;
-    }
-    
-    /* SOP Fetch Section */
-    .sop-fetch-info {
-        background: var(--gray-1);
-        border-radius: var(--radius-md);
-        padding: 0.75rem;
-        margin: 0.5rem 0;
-        font-size: 0.875rem;
-        color: var(--text-secondary);
-    }
-    
-    .sop-fetch-warning {
-        background: rgba(255, 149, 0, 0.1);
-        color: #FF6B00;
-        border: 1px solid rgba(255, 149, 0, 0.3);
-        border-radius: var(--radius-md);
-        padding: 0.75rem;
-        margin: 0.5rem 0;
-        font-size: 0.875rem;
-        font-weight: 500;
-    }
-    
-    /* Responsive design */
-    @media (max-width: 768px) {
-        .user-message {
-            margin: 0 0 0 10% !important;
-        }
-        
-        .assistant-message {
-            margin: 0 10% 0 0 !important;
-        }
-        
-        .welcome-grid {
-            grid-template-columns: 1fr !important;
-        }
-        
-        .input-container {
-            padding: 1rem !important;
-        }
-        
-        .chat-container {
-            padding: 1rem !important;
-        }
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    # Apple-inspired CSS styling (static; loaded once and cached)
+    st.markdown(f"<style>{_load_css()}</style>", unsafe_allow_html=True)
     
     # Check API key from Streamlit secrets or environment
     api_key = st.secrets.get("OPENAI_API_KEY", os.environ.get('OPENAI_API_KEY'))
@@ -835,9 +857,9 @@ def main():
     
     if 'current_chat_id' not in st.session_state:
         if st.session_state.chat_sessions:
-            st.session_state.current_chat_id = list(st.session_state.chat_sessions.keys())[0]
+            st.session_state.current_chat_id = next(iter(st.session_state.chat_sessions))
         else:
-            chat_id = f"chat_{int(time.time())}"
+            chat_id = _new_chat_id()
             st.session_state.chat_sessions[chat_id] = {
                 'title': 'New Chat',
                 'messages': [],
@@ -845,17 +867,11 @@ def main():
             }
             st.session_state.current_chat_id = chat_id
     
-    # Get stats
-    try:
-        collection = chromadb.PersistentClient(path="./chroma_db").get_or_create_collection("sop_documents")
-        chunk_count = collection.count()
-        if chunk_count > 0:
-            metadata = collection.get(include=['metadatas'])
-            sop_count = len(set(m.get('source', '') for m in metadata['metadatas']))
-        else:
-            sop_count = 0
-    except:
-        sop_count = 0
+    # The SOP count only changes on sync, so it lives in session state and is
+    # read back as an attribute instead of re-scanning collection metadata
+    if 'sop_count' not in st.session_state:
+        st.session_state.sop_count = _initial_sop_count()
+    sop_count = st.session_state.sop_count
     
     # Header
     st.markdown("""
@@ -882,16 +898,16 @@ def main():
             
             # New Chat Button
             if st.button("+ New Chat", use_container_width=True, key="new_chat_btn"):
-                chat_id = f"chat_{int(time.time())}"
+                chat_id = _new_chat_id()
                 st.session_state.chat_sessions[chat_id] = {
                     'title': 'New Chat',
                     'messages': [],
                     'created': datetime.now().isoformat()
                 }
                 st.session_state.current_chat_id = chat_id
-                save_chat_sessions(st.session_state.chat_sessions)
+                save_chat_meta(chat_id, st.session_state.chat_sessions[chat_id])
                 st.rerun()
-            
+
             # Clear all button
             col_title, col_clear = st.columns([3, 1])
             with col_clear:
@@ -906,8 +922,10 @@ def main():
                 col_yes, col_no = st.columns(2)
                 with col_yes:
                     if st.button("Yes", key="confirm_yes", type="primary"):
+                        for old_chat_id in st.session_state.chat_sessions:
+                            delete_chat(old_chat_id)
                         # Create a new default chat
-                        chat_id = f"chat_{int(time.time())}"
+                        chat_id = _new_chat_id()
                         st.session_state.chat_sessions = {
                             chat_id: {
                                 'title': 'New Chat',
@@ -916,7 +934,7 @@ def main():
                             }
                         }
                         st.session_state.current_chat_id = chat_id
-                        save_chat_sessions(st.session_state.chat_sessions)
+                        save_chat_meta(chat_id, st.session_state.chat_sessions[chat_id])
                         del st.session_state.confirm_clear_all
                         st.rerun()
                 with col_no:
@@ -925,12 +943,15 @@ def main():
                         st.rerun()
             
             # Individual chats (only show chats with messages)
-            for chat_id, chat_data in st.session_state.chat_sessions.items():
+            sessions = st.session_state.chat_sessions
+            n_sessions = len(sessions)
+            active_chat_id = st.session_state.current_chat_id
+            for chat_id, chat_data in sessions.items():
                 # Skip empty chats unless it's the only one or the current active chat
-                if not chat_data.get('messages', []) and len(st.session_state.chat_sessions) > 1 and chat_id != st.session_state.current_chat_id:
+                if not chat_data.get('messages', []) and n_sessions > 1 and chat_id != active_chat_id:
                     continue
-                    
-                is_active = st.session_state.current_chat_id == chat_id
+
+                is_active = active_chat_id == chat_id
                 title = chat_data.get('title', 'Untitled Chat')
                 
                 col1, col2 = st.columns([5, 1])
@@ -946,40 +967,23 @@ def main():
                 
                 with col2:
                     # Only show delete button if we have more than one chat
-                    if len(st.session_state.chat_sessions) > 1:
+                    if n_sessions > 1:
                         if st.button("🗑️", key=f"delete_{chat_id}", help=f"Delete '{title}'"):
                             # Delete the chat
-                            del st.session_state.chat_sessions[chat_id]
-                            
+                            del sessions[chat_id]
+                            delete_chat(chat_id)
+
                             # If we deleted the current chat, switch to another
                             if st.session_state.current_chat_id == chat_id:
-                                st.session_state.current_chat_id = list(st.session_state.chat_sessions.keys())[0]
-                            
-                            save_chat_sessions(st.session_state.chat_sessions)
+                                st.session_state.current_chat_id = next(iter(sessions))
                             st.rerun()
         
         st.markdown("---")
         
         # AI Configuration Section
-        with st.container():
-            st.markdown("**🤖 AI Configuration**")
-            model_options = {
-                "GPT-4o": "gpt-4o",
-                "GPT-4o-mini": "gpt-4o-mini", 
-                "GPT-4 Turbo": "gpt-4-turbo",
-                "GPT-3.5 Turbo": "gpt-3.5-turbo"
-            }
-            
-            if 'selected_model' not in st.session_state:
-                st.session_state.selected_model = "gpt-4o-mini"
-            
-            selected_model_name = st.selectbox(
-                "Model:",
-                options=list(model_options.keys()),
-                index=list(model_options.values()).index(st.session_state.selected_model),
-                label_visibility="collapsed"
-            )
-            st.session_state.selected_model = model_options[selected_model_name]
+        if 'selected_model' not in st.session_state:
+            st.session_state.selected_model = "gpt-4o-mini"
+        _sidebar_config()
         
         st.markdown("---")
         
@@ -987,12 +991,8 @@ def main():
         with st.container():
             st.markdown("**🔄 SOP Management**")
             
-            # Initialize fetcher
-            if 'sop_fetcher' not in st.session_state:
-                st.session_state.sop_fetcher = SOPFetcher()
-            
-            # Get fetch status
-            fetch_status = st.session_state.sop_fetcher.get_fetch_status()
+            # Get fetch status (cached briefly — every rerun would re-stat the directory)
+            fetch_status = _cached_fetch_status()
             
             # Display last fetch info
             if fetch_status["last_fetch"]:
@@ -1009,7 +1009,7 @@ def main():
             if st.button("🔄 Sync SOPs", use_container_width=True, key="fetch_sops_btn"):
                 with st.spinner("Analyzing SOP directory..."):
                     # Analyze what needs to be done
-                    new_files, modified_files, deleted_files = st.session_state.sop_fetcher.analyze_directory()
+                    new_files, modified_files, deleted_files, _ = _sop_fetcher().analyze_directory()
                     
                     # Show preview
                     total_changes = len(new_files) + len(modified_files) + len(deleted_files)
@@ -1026,7 +1026,7 @@ def main():
                             status_text.text(message)
                         
                         # Fetch and index
-                        results = st.session_state.sop_fetcher.fetch_and_index_sops(update_progress)
+                        results = _sop_fetcher().fetch_and_index_sops(update_progress)
                         
                         # Clear progress indicators
                         progress_bar.empty()
@@ -1040,11 +1040,11 @@ def main():
                         else:
                             st.success(f"✅ Successfully processed {results['total_processed']} files!")
                         
-                        # Update the SOP count
-                        collection = chromadb.PersistentClient(path="./chroma_db").get_or_create_collection("sop_documents")
-                        metadata = collection.get(include=['metadatas'])
-                        sop_count = len(set(m.get('source', '') for m in metadata['metadatas']))
-                        
+                        # Update the SOP count from the fetcher's running tally
+                        # instead of re-scanning collection metadata
+                        st.session_state.sop_count = results.get('unique_source_count', sop_count)
+
+                        _cached_fetch_status.clear()
                         st.rerun()
                     else:
                         st.success("✅ All SOPs are up to date!")
@@ -1069,7 +1069,7 @@ def main():
                 st.metric("SOPs", sop_count, label_visibility="collapsed")
                 st.caption("📚 Total SOPs")
             with col_stat2:
-                st.metric("Model", selected_model_name.replace('GPT-', ''), label_visibility="collapsed")
+                st.metric("Model", _MODEL_NAME_BY_ID[st.session_state.selected_model].replace('GPT-', ''), label_visibility="collapsed")
                 st.caption("🧠 AI Model")
     
     # Main content area
@@ -1087,20 +1087,12 @@ def main():
         
         # Suggestion buttons
         col1, col2 = st.columns(2)
-        with col1:
-            if st.button("📊 How many SOPs do we have?", key="q1", help="Get SOP count"):
-                st.session_state.temp_query = "How many SOPs do we have?"
-                st.rerun()
-            if st.button("💳 How do I process an invoice?", key="q2", help="Invoice procedures"):
-                st.session_state.temp_query = "How do I process an invoice?"
-                st.rerun()
-        with col2:
-            if st.button("💰 What are payment procedures?", key="q3", help="Payment process"):
-                st.session_state.temp_query = "What are payment procedures?"
-                st.rerun()
-            if st.button("📋 Show accounts payable process", key="q4", help="AP process"):
-                st.session_state.temp_query = "Show accounts payable process"
-                st.rerun()
+        for column, suggestions in ((col1, _SUGGESTIONS[:2]), (col2, _SUGGESTIONS[2:])):
+            with column:
+                for label, key, help_text, query in suggestions:
+                    if st.button(label, key=key, help=help_text):
+                        st.session_state.temp_query = query
+                        st.rerun()
     else:
         # Clear current chat button
         col_space, col_clear = st.columns([10, 1])
@@ -1108,131 +1100,23 @@ def main():
             if st.button("🗑️", key="clear_current_chat", help="Clear this chat"):
                 current_chat['messages'] = []
                 current_chat['title'] = 'New Chat'
-                save_chat_sessions(st.session_state.chat_sessions)
+                save_chat(st.session_state.current_chat_id, current_chat)
                 st.rerun()
         
-        # Chat messages
+        # Chat messages — only the most recent window is rendered so long chats
+        # don't emit hundreds of widgets on every rerun
         st.markdown('<div class="chat-messages">', unsafe_allow_html=True)
-        
-        for i, msg in enumerate(current_chat['messages']):
-            st.markdown('<div class="message-container">', unsafe_allow_html=True)
-            
-            if msg["role"] == "user":
-                # User message with edit functionality
-                col_msg, col_edit = st.columns([20, 1])
-                with col_msg:
-                    st.markdown(f"""
-                    <div class="user-message">
-                        <strong>You</strong><br>{msg["content"]}
-                    </div>
-                    """, unsafe_allow_html=True)
-                with col_edit:
-                    if st.button("✏️", key=f"edit_{i}", help="Edit message"):
-                        st.session_state.editing_message = i
-                        st.session_state.edit_content = msg["content"]
-                        st.rerun()
-                
-                # Edit interface
-                if 'editing_message' in st.session_state and st.session_state.editing_message == i:
-                    st.text_area("Edit your message:", 
-                               value=st.session_state.edit_content, 
-                               key=f"edit_text_{i}",
-                               height=100)
-                    
-                    col_save, col_cancel = st.columns(2)
-                    with col_save:
-                        if st.button("💾 Save", key=f"save_{i}"):
-                            new_content = st.session_state[f"edit_text_{i}"]
-                            if new_content.strip():
-                                # Update and regenerate
-                                current_chat['messages'][i]['content'] = new_content
-                                current_chat['messages'] = current_chat['messages'][:i+1]
-                                
-                                del st.session_state.editing_message
-                                del st.session_state.edit_content
-                                
-                                save_chat_sessions(st.session_state.chat_sessions)
-                                
-                                # Regenerate response
-                                with st.spinner("Regenerating response..."):
-                                    uploaded_context_edit = ""
-                                    document_sources_edit = []
-                                    
-                                    sop_chunks = st.session_state.assistant.search_sops(new_content)
-                                    all_sources_edit = document_sources_edit + sop_chunks
-                                    
-                                    # Get conversation history up to the edited message
-                                    conversation_history_edit = current_chat['messages'][:i] if i > 0 else []
-                                    
-                                    ai_prompt = st.session_state.assistant.generate_response(
-                                        new_content, sop_chunks, uploaded_context_edit, sop_count, conversation_history_edit
-                                    )
-                                    
-                                    # Build message array for OpenAI API
-                                    messages_edit = [
-                                        {"role": "system", "content": """You are a professional SOP assistant. Your responses should be:
-- EXTREMELY comprehensive and detailed (aim for 500-2000+ words - be as thorough as possible!)
-- Conversational and engaging, acknowledging previous context extensively
-- Well-structured with multiple clear headings, bullet points, numbered lists, and detailed examples
-- Practical with comprehensive step-by-step guidance and implementation details
-- Reference specific documents and sources, including relevant quotes
-- Build upon previous conversation context naturally and extensively
-- Include background information, context, best practices, potential pitfalls, and comprehensive explanations
-- Use detailed formatting with sections, subsections, and thorough coverage of all aspects
-- Never be brief - always provide maximum detail and comprehensive coverage"""},
-                                        {"role": "user", "content": ai_prompt}
-                                    ]
-                                    
-                                    response_placeholder = st.empty()
-                                    full_response = ""
-                                    
-                                    for token in st.session_state.assistant.stream_response(messages_edit, st.session_state.selected_model):
-                                        full_response += token
-                                        response_placeholder.markdown(f"""
-                                        <div class="assistant-message">
-                                            <strong>SOP Assistant</strong><br>{full_response}▌
-                                        </div>
-                                        """, unsafe_allow_html=True)
-                                    
-                                    current_chat['messages'].append({
-                                        "role": "assistant",
-                                        "content": full_response,
-                                        "sources": all_sources_edit
-                                    })
-                                
-                                save_chat_sessions(st.session_state.chat_sessions)
-                                st.rerun()
-                    
-                    with col_cancel:
-                        if st.button("❌ Cancel", key=f"cancel_{i}"):
-                            del st.session_state.editing_message
-                            del st.session_state.edit_content
-                            st.rerun()
-            
-            else:
-                # Assistant message
-                st.markdown(f"""
-                <div class="assistant-message">
-                    <strong>SOP Assistant</strong><br>{msg["content"]}
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # Sources
-                if "sources" in msg and msg["sources"]:
-                    st.markdown("**📚 Source Documents:**")
-                    
-                    unique_sources = set()
-                    for chunk in msg["sources"]:
-                        source_name = chunk['metadata']['source']
-                        if source_name not in unique_sources:
-                            unique_sources.add(source_name)
-                            st.markdown(f"""
-                            <div class="source-card">
-                                📄 {source_name}
-                            </div>
-                            """, unsafe_allow_html=True)
-            
-            st.markdown('</div>', unsafe_allow_html=True)  # Close message-container
+
+        st.session_state.setdefault('visible_window', 20)
+        msgs = current_chat['messages']
+        start = max(0, len(msgs) - st.session_state.visible_window)
+        if start > 0:
+            if st.button(f"⬆️ Load {min(20, start)} older", key="load_older_msgs"):
+                st.session_state.visible_window += 20
+                st.rerun()
+
+        for i, msg in enumerate(msgs[start:], start):
+            _render_message(i, msg, current_chat, sop_count)
         
         st.markdown('</div>', unsafe_allow_html=True)  # Close chat-messages
     
@@ -1284,11 +1168,15 @@ def main():
         prompt = prompt.strip()
         current_chat = st.session_state.chat_sessions[st.session_state.current_chat_id]
         
+        # Start SOP retrieval now so it overlaps with attachment parsing below;
+        # both are I/O-bound, so the turn costs max(parse, search) not the sum
+        search_future = _executor().submit(st.session_state.assistant.search_sops, prompt)
+
         # Get uploaded files context if available
         uploaded_context = ""
         uploaded_file_names = []
         document_sources = []
-        
+
         if uploaded_files:
             with st.spinner(f"Processing {len(uploaded_files)} uploaded document(s)..."):
                 all_contexts = []
@@ -1296,12 +1184,22 @@ def main():
                 if 'documents' not in current_chat:
                     current_chat['documents'] = {}
                 
+                # Memoize extraction by content hash: re-sending a message with
+                # the same attachment still present shouldn't re-parse the file
+                upload_cache = st.session_state.setdefault('_upload_cache', {})
+
                 for i, uploaded_file in enumerate(uploaded_files, 1):
-                    file_context = st.session_state.assistant.extract_text_from_file(uploaded_file)
+                    content_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+                    file_context = upload_cache.get(content_hash)
+                    if file_context is None:
+                        uploaded_file.seek(0)
+                        file_context = st.session_state.assistant.extract_text_from_file(uploaded_file)
+                        upload_cache[content_hash] = file_context
                     file_name = uploaded_file.name
                     
                     # Store each document
-                    current_chat['documents'][file_name] = file_context
+                    doc_entry = _doc_entry(file_name, file_context)
+                    current_chat['documents'][file_name] = doc_entry
                     uploaded_file_names.append(file_name)
                     
                     # Format each document clearly with separators
@@ -1314,7 +1212,7 @@ def main():
                     
                     # Add to document sources with high priority
                     document_sources.append({
-                        'text': file_context[:500] + "..." if len(file_context) > 500 else file_context,
+                        'text': doc_entry['preview'],
                         'metadata': {'source': file_name, 'type': 'uploaded_document'},
                         'similarity': 1.0
                     })
@@ -1332,49 +1230,54 @@ def main():
                 user_display_content = f"{prompt}\n\n**Attached files:**\n{files_list}"
         
         current_chat['messages'].append({"role": "user", "content": user_display_content})
-        
+
         # Update title if first message
         if len(current_chat['messages']) == 1:
             current_chat['title'] = generate_chat_title(prompt)
-        
-        save_chat_sessions(st.session_state.chat_sessions)
+
+        if len(current_chat['messages']) == 1 or uploaded_file_names:
+            # Title or attached documents changed
+            save_chat_meta(st.session_state.current_chat_id, current_chat)
+        append_message(st.session_state.current_chat_id, current_chat['messages'][-1])
         
         # Generate response
         with st.spinner("Analyzing and generating response..."):
+            prompt_lower = prompt.lower()
+
             # If documents are uploaded, prioritize them and severely limit SOP search
             if uploaded_context:
                 # For questions about uploaded documents, don't search SOPs at all
-                sop_keywords = ["sop", "standard operating", "procedure", "database", "all documents"]
-                if any(keyword in prompt.lower() for keyword in sop_keywords):
-                    sop_chunks = st.session_state.assistant.search_sops(prompt)[:2]  # Very limited
+                if _SOP_KEYWORDS_RE.search(prompt):
+                    sop_chunks = search_future.result()[:2]  # Very limited
                 else:
                     sop_chunks = []  # Focus ONLY on uploaded documents
             else:
-                # No uploaded documents, search SOPs normally
-                sop_chunks = st.session_state.assistant.search_sops(prompt)
+                # No uploaded documents, use the full SOP search
+                sop_chunks = search_future.result()
             
-            # Check for references to previously uploaded documents
+            # Check for references to previously uploaded documents.
+            # Tokenize the prompt once; per-document matching is then a hashed
+            # set intersection instead of repeated lower()/split() substring scans.
             referenced_docs = {}
             if 'documents' in current_chat and not uploaded_context:  # Only if no new files uploaded
-                for doc_name, doc_content in current_chat['documents'].items():
-                    if doc_name not in uploaded_file_names:  # Don't duplicate newly uploaded files
-                        doc_base_name = doc_name.split('.')[0].lower()
-                        prompt_lower = prompt.lower()
-                        
-                        if (doc_name.lower() in prompt_lower or 
-                            doc_base_name in prompt_lower or
-                            any(word in prompt_lower for word in doc_base_name.split('_')) or
-                            any(word in prompt_lower for word in doc_base_name.split(' ')) or
-                            'earlier' in prompt_lower or 
-                            'previous' in prompt_lower or
-                            'from before' in prompt_lower):
-                            
-                            referenced_docs[doc_name] = doc_content
-                            document_sources.append({
-                                'text': doc_content[:500] + "..." if len(doc_content) > 500 else doc_content,
-                                'metadata': {'source': doc_name, 'type': 'uploaded_document'},
-                                'similarity': 1.0
-                            })
+                prompt_tokens = frozenset(_WORD_RE.findall(prompt_lower))
+                temporal_reference = _TEMPORAL_RE.search(prompt_lower) is not None
+
+                for doc_name, entry in current_chat['documents'].items():
+                    if doc_name in uploaded_file_names:  # Don't duplicate newly uploaded files
+                        continue
+
+                    if (temporal_reference or
+                        doc_name.lower() in prompt_lower or
+                        _doc_tokens(doc_name, entry) & prompt_tokens):
+
+                        doc_content = _doc_text(entry)
+                        referenced_docs[doc_name] = doc_content
+                        document_sources.append({
+                            'text': _doc_preview(entry),
+                            'metadata': {'source': doc_name, 'type': 'uploaded_document'},
+                            'similarity': 1.0
+                        })
             
             # Combine all document contexts
             all_uploaded_context = uploaded_context
@@ -1392,40 +1295,18 @@ def main():
                 prompt, sop_chunks, all_uploaded_context, sop_count, conversation_history
             )
             
-            # Build message array for OpenAI API
-            messages = [
-                {"role": "system", "content": """You are a professional SOP assistant. Your responses should be:
-- EXTREMELY comprehensive and detailed (aim for 500-2000+ words - be as thorough as possible!)
-- Conversational and engaging, acknowledging previous context extensively
-- Well-structured with multiple clear headings, bullet points, numbered lists, and detailed examples
-- Practical with comprehensive step-by-step guidance and implementation details
-- Reference specific documents and sources, including relevant quotes
-- Build upon previous conversation context naturally and extensively
-- Include background information, context, best practices, potential pitfalls, and comprehensive explanations
-- Use detailed formatting with sections, subsections, and thorough coverage of all aspects
-- Never be brief - always provide maximum detail and comprehensive coverage"""},
-                {"role": "user", "content": ai_prompt}
-            ]
-            
-            # Stream response
-            response_placeholder = st.empty()
-            full_response = ""
-            
-            for token in st.session_state.assistant.stream_response(messages, st.session_state.selected_model):
-                full_response += token
-                response_placeholder.markdown(f"""
-                <div class="assistant-message">
-                    <strong>SOP Assistant</strong><br>{full_response}▌
-                </div>
-                """, unsafe_allow_html=True)
+            full_response = _run_streaming_turn(ai_prompt, st.session_state.selected_model)
             
             current_chat['messages'].append({
                 "role": "assistant",
                 "content": full_response,
-                "sources": all_sources
+                "sources": all_sources,
+                "unique_sources": list(dict.fromkeys(
+                    s['metadata']['source'] for s in all_sources
+                ))
             })
-        
-        save_chat_sessions(st.session_state.chat_sessions)
+
+        append_message(st.session_state.current_chat_id, current_chat['messages'][-1])
         # Don't try to modify the text_area widget's state directly
         st.rerun()
     
@@ -1436,11 +1317,11 @@ def main():
         del st.session_state.temp_query
         
         current_chat['messages'].append({"role": "user", "content": prompt})
-        
+
         if len(current_chat['messages']) == 1:
             current_chat['title'] = generate_chat_title(prompt)
-        
-        save_chat_sessions(st.session_state.chat_sessions)
+            save_chat_meta(st.session_state.current_chat_id, current_chat)
+        append_message(st.session_state.current_chat_id, current_chat['messages'][-1])
         st.rerun()
 
 if __name__ == "__main__":
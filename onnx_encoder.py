@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+ONNX Encoder - Quantized int8 embedding backend for CPU-only deployments
+Exports all-MiniLM-L6-v2 to ONNX once, applies dynamic int8 quantization,
+and serves encodes through ONNX Runtime (~4x faster than eager PyTorch on CPU).
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+ONNX_MODEL_DIR = Path("./onnx_model")
+
+
+class ONNXEncoder:
+    """Drop-in replacement for SentenceTransformer.encode backed by ONNX Runtime"""
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = self._load_model(model_name)
+
+    def _load_model(self, model_name):
+        """Load the quantized model, exporting and quantizing on first use"""
+        quantized_file = ONNX_MODEL_DIR / "model_quantized.onnx"
+        if quantized_file.exists():
+            return ORTModelForFeatureExtraction.from_pretrained(
+                ONNX_MODEL_DIR,
+                file_name=quantized_file.name,
+                provider="CPUExecutionProvider"
+            )
+
+        model = ORTModelForFeatureExtraction.from_pretrained(
+            model_name,
+            export=True,
+            provider="CPUExecutionProvider"
+        )
+        try:
+            model.save_pretrained(ONNX_MODEL_DIR)
+            quantizer = ORTQuantizer.from_pretrained(ONNX_MODEL_DIR)
+            quantizer.quantize(
+                save_dir=ONNX_MODEL_DIR,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False)
+            )
+            return ORTModelForFeatureExtraction.from_pretrained(
+                ONNX_MODEL_DIR,
+                file_name=quantized_file.name,
+                provider="CPUExecutionProvider"
+            )
+        except Exception:
+            # Quantization is best-effort; the plain ONNX export is still faster than eager mode
+            return model
+
+    def encode(self, texts, normalize_embeddings: bool = True, **kwargs):
+        """Encode one string or a list of strings into mean-pooled float32 vectors"""
+        single_input = isinstance(texts, str)
+        if single_input:
+            texts = [texts]
+
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=256,
+            return_tensors="np"
+        )
+        outputs = self.model(**inputs)
+        embeddings = self._mean_pool(
+            np.asarray(outputs.last_hidden_state),
+            np.asarray(inputs["attention_mask"])
+        )
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.clip(norms, 1e-12, None)
+
+        embeddings = embeddings.astype(np.float32)
+        return embeddings[0] if single_input else embeddings
+
+    @staticmethod
+    def _mean_pool(last_hidden_state, attention_mask):
+        """Average token embeddings, ignoring padding positions"""
+        mask = attention_mask[:, :, None].astype(np.float32)
+        summed = (last_hidden_state * mask).sum(axis=1)
+        counts = np.clip(mask.sum(axis=1), 1e-9, None)
+        return summed / counts
+
+
+def create_encoder(model_name: str = MODEL_NAME):
+    """Return the quantized ONNX encoder, falling back to SentenceTransformer if unavailable"""
+    if ONNX_AVAILABLE:
+        try:
+            return ONNXEncoder(model_name)
+        except Exception:
+            pass
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name.split('/')[-1])